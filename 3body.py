@@ -1,3 +1,4 @@
+import math
 import taichi as ti
 ti.init(ti.gpu)
 
@@ -7,12 +8,44 @@ mass_sun = 3.3e5 # ratio of mass of sun and earth is about 3.3e5
 mass_earth = 1.0
 dt = 2e-5
 substep = 2
+cutoff = 0.075 # pairs closer than this do not attract each other
+
+# 0: direct sum over all ordered pairs, O(N^2)
+# 1: Barnes-Hut, O(N log N): a quadtree of mass and center of mass is rebuilt every step and
+#    a cell seen under an angle below theta (size / distance) acts as one body. To honor the
+#    cutoff, cells entirely within it are skipped and cells straddling it are always opened
+# 2: direct sum over unordered pairs in tiles, each force is evaluated once and applied to both bodies.
+#    CPU path: a thread per pair of tiles gives only n_tiles^2 / 2 threads and keeps its partner
+#    tile's forces in a pair_tile x 2 local array, too few and too large for a GPU, use 0 there
+force_mode = 0
+theta = 0.5
+leaf_bodies = 8 # bodies per finest cell the tree depth aims for
+depth = min(max(math.ceil(math.log(max(N / leaf_bodies, 1), 4)), 1), 11) # finest level has 4^depth cells
+pair_tile = min(256, N) # bodies per tile, the two tiles of a pair and the partner's forces stay in L1
+n_tiles = (N + pair_tile - 1) // pair_tile
+n_pairs = n_tiles * (n_tiles + 1) // 2
 
 pos = ti.Vector.field(2, float, N)
 vel = ti.Vector.field(2, float, N)
 force = ti.Vector.field(2, float, N)
 M = ti.field(float, N)
 
+# the tree is a pyramid of dense levels, level l holds 2^l x 2^l cells starting at (4^l - 1) / 3
+n_nodes = (4 ** (depth + 1) - 1) // 3
+n_leaves = 4 ** depth
+node_mass = ti.field(float, n_nodes)
+node_com = ti.Vector.field(2, float, n_nodes) # mass weighted sum of positions, then center of mass
+box_lo = ti.Vector.field(2, float, shape=())
+box_hi = ti.Vector.field(2, float, shape=())
+# bodies sorted by finest cell, the bodies of leaf c are leaf_body[leaf_start[c]:leaf_start[c] + leaf_count[c]]
+leaf_count = ti.field(int, n_leaves)
+leaf_start = ti.field(int, n_leaves)
+leaf_cursor = ti.field(int, n_leaves)
+leaf_body = ti.field(int, N)
+body_leaf = ti.field(int, N)
+leaf_pos = ti.Vector.field(2, float, N) # positions and masses in leaf order, read contiguously
+leaf_M = ti.field(float, N)
+
 @ti.kernel
 def initialize():
     for i in pos:
@@ -27,7 +60,7 @@ def initialize():
 
 
 @ti.kernel
-def compute_force():
+def direct_force():
     for i in pos:
         force[i] = ti.Vector([0.0, 0.0])
 
@@ -36,11 +69,145 @@ def compute_force():
         for j in range(N):
             if i != j:
                 dis = p - pos[j]
-                if dis.norm() > 0.075:
+                if dis.norm() > cutoff:
                     f = -G * M[i] * M[j] / (dis.norm() * dis.norm())
                     force[i] += f * dis / dis.norm()
 
 
+@ti.func
+def attraction(p, q, m): # acceleration at p towards mass m at q
+    dis = p - q
+    r = dis.norm()
+    res = ti.Vector([0.0, 0.0])
+    if r > cutoff:
+        res = -G * m / (r * r * r) * dis
+    return res
+
+
+@ti.kernel
+def pair_force():
+    for i in pos:
+        force[i] = ti.Vector([0.0, 0.0])
+
+    for t in range(n_pairs): # one thread per unordered pair of tiles a <= b, t = b (b + 1) / 2 + a
+        b = int((ti.sqrt(8.0 * t + 1) - 1) / 2)
+        b += (b + 1) * (b + 2) // 2 <= t # rounding of the square root
+        b -= b * (b + 1) // 2 > t
+        a = t - b * (b + 1) // 2
+        b0 = b * pair_tile
+        b1 = ti.min(b0 + pair_tile, N)
+        fb = ti.Matrix.zero(float, pair_tile, 2) # forces on the bodies of tile b
+        for i in range(a * pair_tile, ti.min(a * pair_tile + pair_tile, N)):
+            p = pos[i]
+            fi = ti.Vector([0.0, 0.0])
+            for j in range(ti.max(b0, i + 1), b1): # the diagonal tile only takes j > i
+                f = M[i] * attraction(p, pos[j], M[j])
+                fi += f
+                fb[j - b0, 0] -= f[0]
+                fb[j - b0, 1] -= f[1]
+            force[i] += fi
+        for j in range(b0, b1):
+            force[j] += ti.Vector([fb[j - b0, 0], fb[j - b0, 1]])
+
+
+@ti.func
+def level_start(l):
+    return ((1 << 2 * l) - 1) // 3
+
+
+@ti.kernel
+def build_tree():
+    box_lo[None] = pos[0]
+    box_hi[None] = pos[0]
+    for i in pos:
+        ti.atomic_min(box_lo[None], pos[i])
+        ti.atomic_max(box_hi[None], pos[i])
+    # square root cell, slightly enlarged so every body falls strictly inside
+    size = (box_hi[None] - box_lo[None]).max() * 1.001 + 1e-6
+    box_hi[None] = box_lo[None] + size
+
+    for c in leaf_count:
+        leaf_count[c] = 0
+    for n in node_mass:
+        node_mass[n] = 0
+        node_com[n] = ti.Vector([0.0, 0.0])
+    for i in pos:
+        cell = ti.min(int((pos[i] - box_lo[None]) / size * 2 ** depth), 2 ** depth - 1)
+        body_leaf[i] = cell[0] * 2 ** depth + cell[1]
+        ti.atomic_add(leaf_count[body_leaf[i]], 1)
+        node_mass[level_start(depth) + body_leaf[i]] += M[i]
+        node_com[level_start(depth) + body_leaf[i]] += M[i] * pos[i]
+    start = 0
+    ti.loop_config(serialize=True)
+    for c in range(n_leaves):
+        leaf_start[c] = start
+        leaf_cursor[c] = start
+        start += leaf_count[c]
+    for i in pos:
+        k = ti.atomic_add(leaf_cursor[body_leaf[i]], 1)
+        leaf_body[k] = i
+        leaf_pos[k] = pos[i]
+        leaf_M[k] = M[i]
+
+    for k in ti.static(range(depth)): # parents from their 4 children, finest level first
+        l = depth - 1 - k
+        for x, y in ti.ndrange(2 ** l, 2 ** l):
+            n = level_start(l) + x * 2 ** l + y
+            for a, b in ti.static(ti.ndrange(2, 2)):
+                child = level_start(l + 1) + (2 * x + a) * 2 ** (l + 1) + 2 * y + b
+                node_mass[n] += node_mass[child]
+                node_com[n] += node_com[child]
+    for n in node_mass:
+        if node_mass[n] > 0:
+            node_com[n] /= node_mass[n]
+
+
+@ti.kernel
+def tree_force():
+    size = box_hi[None][0] - box_lo[None][0]
+    for q in leaf_body: # in leaf order, neighboring threads walk similar parts of the tree
+        i = leaf_body[q]
+        p = pos[i]
+        acc = ti.Vector([0.0, 0.0])
+        stack = ti.Vector.zero(int, 64) # level << 24 | x << 12 | y
+        top = 1
+        while top > 0:
+            top -= 1
+            l = stack[top] >> 24
+            x = (stack[top] >> 12) & 0xFFF
+            y = stack[top] & 0xFFF
+            n = level_start(l) + x * (1 << l) + y
+            if node_mass[n] > 0:
+                s = size / (1 << l)
+                lo = box_lo[None] + ti.Vector([x, y]) * s
+                near = (ti.max(lo - p, 0.0) + ti.max(p - lo - s, 0.0)).norm() # 0 for the cell holding p
+                far = ti.max(ti.abs(p - lo), ti.abs(p - lo - s)).norm()
+                if far <= cutoff: # every body of the cell is within the cutoff
+                    pass
+                elif near > cutoff and s < theta * (node_com[n] - p).norm():
+                    acc += attraction(p, node_com[n], node_mass[n])
+                elif l == depth:
+                    c = x * 2 ** depth + y
+                    for k in range(leaf_start[c], leaf_start[c] + leaf_count[c]):
+                        if k != q:
+                            acc += attraction(p, leaf_pos[k], leaf_M[k])
+                else:
+                    for a, b in ti.static(ti.ndrange(2, 2)):
+                        stack[top] = (l + 1) << 24 | (2 * x + a) << 12 | (2 * y + b)
+                        top += 1
+        force[i] = M[i] * acc
+
+
+def compute_force():
+    if force_mode == 1:
+        build_tree()
+        tree_force()
+    elif force_mode == 2:
+        pair_force()
+    else:
+        direct_force()
+
+
 @ti.kernel
 def update():
     t = dt / substep
@@ -5,6 +5,7 @@ import math
 ti.init(arch=ti.gpu)
 
 visualization = 1
+periodic_x = False # wrap the domain along x instead of bounding it with side walls; boundX can then be much narrower
 
 # boundary
 boundX = 25.0 * ti.sqrt(10.0)
@@ -14,9 +15,16 @@ boundY = 40.0 * ti.sqrt(10.0)
 wallNumX = int(boundX // 0.5) - 5
 wallNumY = int(boundY // 0.5) - 5
 wallNum = wallNumX * 3 + (wallNumY - 3) * 6
+wallGapX = 0.5
+if periodic_x: # floor only, spanning exactly one period
+    wallNumX = int(boundX // 0.5)
+    wallGapX = boundX / wallNumX
+    wallNum = wallNumX * 3
 
 fluid_n = 5000
 total_num = fluid_n + wallNum
+if periodic_x: # each layer is fluid_n / 2 particles in rows as wide as the period, stacked from 0.05 * boundY
+    assert 0.05 * boundY + 2 * math.ceil(fluid_n / 2 / int(boundX / 0.65)) * 0.65 < boundY - 2, 'boundX too narrow for fluid_n'
 phase = 2
 h = 1.1
 g = ti.Vector.field(2, float, shape=1)
@@ -47,6 +55,11 @@ alpha = ti.field(float, shape=(fluid_n, phase))
 # cell
 cellSize = 4.0
 numCellX = ti.ceil(boundX / cellSize)
+cellSizeX = cellSize
+if periodic_x: # cells have to tile one period exactly
+    numCellX = int(boundX // cellSize)
+    cellSizeX = boundX / numCellX
+    assert numCellX >= 3, "periodic domain needs at least 3 cells along x"
 numCellY = ti.ceil(boundY / cellSize)
 numCell = numCellX * numCellY
 
@@ -81,18 +94,37 @@ def DW(r):
     return res
     
 
+@ti.func
+def rel(i, j): # pos[i] - pos[j], taken to the nearest periodic image
+    r = pos[i] - pos[j]
+    if ti.static(periodic_x):
+        r[0] -= boundX * ti.round(r[0] / boundX)
+    return r
+
+
+@ti.func
+def cell_x(x) -> int:
+    res = int(x / cellSize - 0.5)
+    if ti.static(periodic_x):
+        res = int(x / cellSizeX) % numCellX
+    return res
+
+
 @ti.func
 def boundry(idx:int):
     eps = 0.5
-    if pos[idx][0] > boundX - eps:
-        pos[idx][0] = boundX - eps
-        if vel[idx][0] > 0.0:
-            vel[idx][0] = - 0.999 * vel[idx][0]
-    
-    if pos[idx][0] < eps:
-        pos[idx][0] = eps
-        if vel[idx][0] < 0.0:
-            vel[idx][0] = - 0.999 * vel[idx][0]
+    if ti.static(periodic_x):
+        pos[idx][0] -= boundX * ti.floor(pos[idx][0] / boundX)
+    else:
+        if pos[idx][0] > boundX - eps:
+            pos[idx][0] = boundX - eps
+            if vel[idx][0] > 0.0:
+                vel[idx][0] = - 0.999 * vel[idx][0]
+        
+        if pos[idx][0] < eps:
+            pos[idx][0] = eps
+            if vel[idx][0] < 0.0:
+                vel[idx][0] = - 0.999 * vel[idx][0]
 
     if pos[idx][1] > boundY - eps:
         pos[idx][1] = boundY - eps
@@ -113,12 +145,12 @@ def neighbor_search():
     neighbor.fill(0)
 
     for i in pos:
-        idx = int(pos[i][0]/cellSize-0.5) + int(pos[i][1]/cellSize-0.5) * numCellX
+        idx = cell_x(pos[i][0]) + int(pos[i][1]/cellSize-0.5) * numCellX
         k = ti.atomic_add(ParNum[int(idx)], 1)
         Particles[int(idx), k] = i
 
     for i in range(fluid_n):
-        idx_x = int(pos[i][0]/cellSize - 0.5)
+        idx_x = cell_x(pos[i][0])
         idx_y = int(pos[i][1]/cellSize - 0.5)
         kk = 0
         for j in range(9):
@@ -126,12 +158,14 @@ def neighbor_search():
             dy = ti.Vector([0, 1, 1, 1, 0, -1, -1, -1, 0])
             new_x = idx_x + dx[j]
             new_y = idx_y + dy[j]
+            if ti.static(periodic_x):
+                new_x = (new_x + numCellX) % numCellX
             if new_x<numCellX and new_x>=0 and new_y<numCellY and new_y>=0:
                 new_idx = int(new_x) + int(new_y * numCellX)
                 cnt = ParNum[new_idx]
                 for t in range(cnt):
                     nei = Particles[new_idx, t]
-                    if nei!=i and (pos[nei]-pos[i]).norm() < 1.1*h:
+                    if nei!=i and rel(nei, i).norm() < 1.1*h:
                         neighbor[i, kk] = nei
                         kk += 1
         NeiNum[i] = kk
@@ -144,11 +178,17 @@ def init():
     g[0] = ti.Vector([0.0, -9.8])
     mid = fluid_n / 2
     num = int(tm.sqrt(mid))
+    left = 0.4*boundX
+    upper = 0.35*boundY
+    if ti.static(periodic_x): # layers span the whole period, the upper one starts a spacing above the lower one
+        num = int(boundX / 0.65)
+        left = 0.5 * (boundX - num * 0.65)
+        upper = 0.05*boundY + (mid + num - 1) // num * 0.65
 
     for i in range(mid):
         posx = (i % num) * 0.65
         posy = (i // num) * 0.65
-        pos[i] = ti.Vector([0.4*boundX + posx, 0.05*boundY + posy])        
+        pos[i] = ti.Vector([left + posx, 0.05*boundY + posy])        
         alpha[i, 0] = 0.0
         alpha[i, 1] = 1.0
 
@@ -156,22 +196,26 @@ def init():
         j = i - mid
         posx = (j % num) * 0.65
         posy = (j // num) * 0.65
-        pos[i] = ti.Vector([0.4*boundX + posx, 0.35*boundY + posy])        
+        pos[i] = ti.Vector([left + posx, upper + posy])        
         alpha[i, 0] = 1.0
         alpha[i, 1] = 0.0
     
     for i in range(wallNumX):
-        pos[fluid_n+3*i] = ti.Vector([(i+1) * 0.5, 0.5])
-        pos[fluid_n+3*i+1] = ti.Vector([(i+1) * 0.5, 1.0])
-        pos[fluid_n+3*i+2] = ti.Vector([(i+1) * 0.5, 1.5])
+        x = (i+1) * wallGapX
+        if ti.static(periodic_x):
+            x = (i+0.5) * wallGapX
+        pos[fluid_n+3*i] = ti.Vector([x, 0.5])
+        pos[fluid_n+3*i+1] = ti.Vector([x, 1.0])
+        pos[fluid_n+3*i+2] = ti.Vector([x, 1.5])
     
-    for i in range(wallNumY-3):
-        pos[fluid_n+wallNumX*3+6*i] = ti.Vector([0.5, (i+4) * 0.5])
-        pos[fluid_n+wallNumX*3+6*i+1] = ti.Vector([1.0, (i+4) * 0.5])
-        pos[fluid_n+wallNumX*3+6*i+2] = ti.Vector([1.5, (i+4) * 0.5])
-        pos[fluid_n+wallNumX*3+6*i+3] = ti.Vector([(wallNumX-2)*0.5, (i+4) * 0.5])
-        pos[fluid_n+wallNumX*3+6*i+4] = ti.Vector([(wallNumX-1)*0.5, (i+4) * 0.5])
-        pos[fluid_n+wallNumX*3+6*i+5] = ti.Vector([(wallNumX-0)*0.5, (i+4) * 0.5])
+    if ti.static(not periodic_x): # side walls
+        for i in range(wallNumY-3):
+            pos[fluid_n+wallNumX*3+6*i] = ti.Vector([0.5, (i+4) * 0.5])
+            pos[fluid_n+wallNumX*3+6*i+1] = ti.Vector([1.0, (i+4) * 0.5])
+            pos[fluid_n+wallNumX*3+6*i+2] = ti.Vector([1.5, (i+4) * 0.5])
+            pos[fluid_n+wallNumX*3+6*i+3] = ti.Vector([(wallNumX-2)*0.5, (i+4) * 0.5])
+            pos[fluid_n+wallNumX*3+6*i+4] = ti.Vector([(wallNumX-1)*0.5, (i+4) * 0.5])
+            pos[fluid_n+wallNumX*3+6*i+5] = ti.Vector([(wallNumX-0)*0.5, (i+4) * 0.5])
 
 
 @ti.kernel
@@ -186,9 +230,9 @@ def cal_press():
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
             if j < fluid_n: # particle
-                rho_bar[i] += rho_m[j] * W((pos[i] - pos[j]).norm())
+                rho_bar[i] += rho_m[j] * W((rel(i, j)).norm())
             else: # Wall
-                rho_bar[i] += rho_0[0] * W((pos[i] - pos[j]).norm())
+                rho_bar[i] += rho_0[0] * W((rel(i, j)).norm())
 
         if rho_bar[i] < 1e-6:
             rho_bar[i] = rho_m[i]
@@ -214,9 +258,9 @@ def cal_drift():
                 j = neighbor[i, nei]
                 if j < fluid_n:
                     if miscible:
-                        prs_grad += rho_m[j] * (alpha[j, k] * prs[j] - alpha[i, k] * prs[i]) * DW(pos[i] - pos[j]) / rho_bar[j]
+                        prs_grad += rho_m[j] * (alpha[j, k] * prs[j] - alpha[i, k] * prs[i]) * DW(rel(i, j)) / rho_bar[j]
                     else:
-                        prs_grad += rho_m[j] * (prs[j] - prs[i]) * DW(pos[i] - pos[j]) / rho_bar[j]
+                        prs_grad += rho_m[j] * (prs[j] - prs[i]) * DW(rel(i, j)) / rho_bar[j]
 
             second_term -= alpha[i, ph] * rho_0[ph] * prs_grad / rho_m[i]
             if ph==i:
@@ -234,7 +278,7 @@ def adv_alpha(): # formula 17, 18
             j = neighbor[i, nei]
             if j < fluid_n:
                 temp1 = rho_m[j] * (alpha[i, k] + alpha[j, k]) / (2.0 * rho_bar[j])
-                temp2 = (vel[j] - vel[i]).dot(DW(pos[i] - pos[j]))
+                temp2 = (vel[j] - vel[i]).dot(DW(rel(i, j)))
                 first_term += temp1 * temp2
 
         second_term = 0.0
@@ -242,7 +286,7 @@ def adv_alpha(): # formula 17, 18
             j = neighbor[i, nei]
             if j < fluid_n:
                 temp1 = rho_m[j] / rho_bar[j]
-                temp2 = (alpha[j, k] * drift_vel[j, k] + alpha[i, k] * drift_vel[i, k]).dot(DW(pos[i] - pos[j]))
+                temp2 = (alpha[j, k] * drift_vel[j, k] + alpha[i, k] * drift_vel[i, k]).dot(DW(rel(i, j)))
                 second_term += temp1 * temp2
 
         alpha[i, k] -= (first_term + second_term) * dt
@@ -284,17 +328,17 @@ def cal_acc():
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
             if j < fluid_n: # partical
-                prs_grad += rho_m[j] * (prs[i] + prs[j]) / (2 * rho_bar[j]) * DW(pos[i] - pos[j])
+                prs_grad += rho_m[j] * (prs[i] + prs[j]) / (2 * rho_bar[j]) * DW(rel(i, j))
             else: # Wall
-                prs_grad += rho_0[0] * (prs[i] + prs[i]) / (2 * rho_0[0]) * DW(pos[i] - pos[j])
+                prs_grad += rho_0[0] * (prs[i] + prs[i]) / (2 * rho_0[0]) * DW(rel(i, j))
 
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
             if j < fluid_n:
                 temp = ti.Vector([0.0, 0.0])
                 for k in range(phase):
-                    temp1 = alpha[j, k] * drift_vel[j, k] * (drift_vel[j, k].dot(DW(pos[i] - pos[j])))
-                    temp2 = alpha[i, k] * drift_vel[i, k] * (drift_vel[i, k].dot(DW(pos[i] - pos[j])))
+                    temp1 = alpha[j, k] * drift_vel[j, k] * (drift_vel[j, k].dot(DW(rel(i, j))))
+                    temp2 = alpha[i, k] * drift_vel[i, k] * (drift_vel[i, k].dot(DW(rel(i, j))))
                     temp += (temp1 + temp2) * rho_0[k]
 
                 Tdm_grad -= (rho_m[j] / rho_bar[j]) * temp
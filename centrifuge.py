@@ -3,29 +3,13 @@ import taichi.math as tm
 import numpy as np
 import math
 import time
-
-def cal_fluidn(water_radius:int, wall_radius:int, height:int, dis:float) -> int:
-    res_n = 0
-    for i in range(1, water_radius + 1):
-        cur_r = i * dis
-        d_theta = 2.0 * tm.asin(0.5 * dis / cur_r)
-        num = int((2 * tm.pi) / d_theta)
-        num_circle[i-1] = num
-        res_n += num
-    
-    for i in range(wall_radius):
-        cur_r = water_radius * dis + (i+1) * 0.5 * dis
-        d_theta = 2.0 * tm.asin(0.5 * dis / cur_r)
-        num = int((2 * tm.pi) / d_theta)
-        num_circle[i+water_radius] = num
-        res_n += num
-    
-    return res_n * height
-
+import sdf_boundary
+import scene_builder
 
 ti.init(arch=ti.gpu)
 show_type = 0
 visualization = 1
+boundary_mode = 0 # 0: wall particles, 1: precomputed density map
 
 # parameters
 particle_radius = 1.0
@@ -47,9 +31,11 @@ boundX = ti.ceil(2 * total_radius) + 4
 boundY = ti.ceil(2 * total_radius) + 4
 boundZ = ti.ceil(total_height) + 4
 
-num_circle = ti.field(int, shape=centrifuge_radius)
-fluid_n = int(cal_fluidn(centrifuge_radius, 0, centrifuge_height, particle_distance))
-total_num = int(cal_fluidn(centrifuge_radius, wall_layer, centrifuge_height + 2 * wall_layer, particle_distance))
+scene = scene_builder.cached(scene_builder.centrifuge, center=[boundX / 2, boundY / 2], water_radius=centrifuge_radius,
+                             wall_radius=wall_layer, height=centrifuge_height, wall_layer=wall_layer,
+                             dis=particle_distance, walls=boundary_mode == 0)
+fluid_n = len(scene['fluid'])
+total_num = fluid_n + len(scene['wall'])
 phase = 2
 
 tao = 1e-7
@@ -78,6 +64,14 @@ Particles = ti.field(int, shape = (numCellX, numCellY, numCellZ, 20000))
 NeiNum = ti.field(int, shape = fluid_n)
 neighbor = ti.field(int, shape = (fluid_n, 2000))
 
+# boundary map
+bmap = None
+if boundary_mode == 1:
+    bmap = sdf_boundary.Cylinder(center=[boundX / 2, boundY / 2], radius=(centrifuge_radius + 0.25) * particle_distance,
+                                 z_lo=(wall_layer + 0.5) * particle_distance, z_hi=(wall_layer + centrifuge_height + 0.5) * particle_distance,
+                                 side=wall_layer * 0.5 * particle_distance, cap=wall_layer * particle_distance, dx=particle_distance, h=h,
+                                 n_side=2.0 / particle_distance**3, n_cap=1.0 / particle_distance**3, sample_dx=0.5 * particle_distance)
+
 # rendering
 palette = ti.Vector.field(3, float, shape = fluid_n)
 render_pos = ti.Vector.field(3, float, shape = fluid_n)
@@ -173,35 +167,9 @@ def neighbor_search():
 def init():
     rho_0[0] = 1000.0 # water
     rho_0[1] = 500.0  # oil
-    center_x = boundX / 2
-    center_y = boundY / 2
-    fluid_id = 0
-    wall_id = total_num - 1
-    for i, j in ti.ndrange((1, centrifuge_radius + wall_layer + 1), (1, centrifuge_height + 2*wall_layer + 1)):
-        cur_r = 0.0
-        if i <= centrifuge_radius :
-            cur_r = i * particle_distance
-        else :
-            cur_r = centrifuge_radius * particle_distance + (i-centrifuge_radius) * 0.5 * particle_distance
-
-        d_theta = 2.0 * tm.asin(0.5 * particle_distance / cur_r)
-        center = ti.Vector([center_x, center_y, j * particle_distance])
-        cur_theta = 0.0
-        num = num_circle[i-1]
-        while num > 0 :
-            if i <= centrifuge_radius and j > wall_layer and j <= centrifuge_height + wall_layer:
-                temp = ti.atomic_add(fluid_id, 1)
-                pos[temp] = cur_r * ti.Vector([tm.cos(cur_theta), tm.sin(cur_theta), 0]) + center
-                alpha[temp, 0] = 0.6
-                alpha[temp, 1] = 0.4
-            else:
-                temp = ti.atomic_sub(wall_id, 1)
-                pos[temp] = cur_r * ti.Vector([tm.cos(cur_theta), tm.sin(cur_theta), 0]) + center
-
-            cur_theta += d_theta
-            num -= 1
-
-    print(fluid_id, wall_id)
+    for i in range(fluid_n):
+        alpha[i, 0] = 0.6
+        alpha[i, 1] = 0.4
     
    
 @ti.kernel
@@ -220,6 +188,9 @@ def cal_press():
             else: # Wall
                 rho_bar[i] += rho_wall * W((pos[i] - pos[j]).norm())
 
+        if ti.static(boundary_mode == 1):
+            rho_bar[i] += rho_wall * bmap.density(pos[i])
+
         if rho_bar[i] < 1e-6:
             rho_bar[i] = rho_m[i]
     
@@ -323,6 +294,9 @@ def cal_acc():
             else: # Wall
                 prs_grad += rho_wall * (prs[i] + prs[i]) / (2 * rho_0[0]) * DW(pos[i] - pos[j])
 
+        if ti.static(boundary_mode == 1):
+            prs_grad += rho_wall * prs[i] / rho_0[0] * bmap.gradient(pos[i])
+
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
             if j < fluid_n:
@@ -358,7 +332,10 @@ def pre_render():
        
 
 if __name__ == '__main__':
+    pos.from_numpy(np.concatenate([scene['fluid'], scene['wall']]))
     init()
+    if boundary_mode == 1:
+        bmap.build()
     print(dt)
     gui = ti.ui.Window('SPH', res = (700, 700))
     canvas = gui.get_canvas()
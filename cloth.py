@@ -1,9 +1,11 @@
 import taichi as ti
+import numpy as np
 from math import *
+import cloth_collision
 
 ti.init(arch=ti.cpu)
 
-N = 21
+N = 256
 len_cloth = 10
 
 pos_vertex = ti.Vector.field(3, float, shape=(N*N))
@@ -12,7 +14,7 @@ fixed = ti.field(bool, shape=(N*N))
 cnt_triangle = (N-1) * (N-1) * 2
 indice = ti.field(int, shape=cnt_triangle*3)
 colors = ti.Vector.field(3, float, shape=(N*N))
-sum_cal = ti.field(int, shape=(N*N))
+sum_cal = ti.field(int, shape=(N*N)) # constraints per vertex, counted once in init_scence()
 sum_x = ti.Vector.field(3, float, shape=(N*N))
 len_edge = len_cloth / (N - 1)
 g = 0.98
@@ -20,11 +22,48 @@ dt = 1.0/30.0
 damp = 0.99
 substep = 32
 
+# constraints are built from the triangles in init_scence(), so any triangle mesh works:
+# structural along every edge, shear across the shared longest edge of two triangles (the
+# diagonal of a quad) and optionally bending across every other interior edge
+bending = False
+bending_compliance = 1e-3
+
+# 0: Jacobi averaging over the constraints, limiting() substep times per frame
+# 1: XPBD distance constraints solved Gauss-Seidel style over a graph coloring: constraints of
+#    one color share no vertex, so each color is projected in parallel without atomics
+solver = 1
+xpbd_substeps = 8 # a frame is split into substeps, each predicts, sweeps xpbd_iters times and collides;
+xpbd_iters = 1    # more small steps converge much faster than more sweeps of one big step
+h = dt / xpbd_substeps
+compliance = 0.0 # inverse stiffness of the edges, 0 is inextensible; does not depend on the step counts
+prev_pos = ti.Vector.field(3, float, shape=(N*N))
+
+# both solvers: every sweep reports the rms relative stretch of the constraints it measured
+# (kept in residuals for the last frame) and the sweeps of a step stop once it drops below
+# tolerance; 0 always runs all of them. Constraints at pinned vertices are left out, their
+# stretch is the largest and barely changes from sweep to sweep.
+# Chebyshev semi-iterative acceleration (Wang 2015) extrapolates a sweep from the previous
+# two iterates, after cheb_delay plain sweeps and never after the last sweep of a step, and
+# restarts whenever the residual grows. Off for XPBD: the extrapolation moves positions the
+# lambda accumulators know nothing about and short substeps turn it into velocity
+tolerance = 0.0
+chebyshev = solver == 0
+cheb_delay = 2
+rho = 0.99 if solver == 0 else 0.9 # estimated spectral radius of the plain sweep, too large diverges
+cheb_gamma = 1.0 # under-relaxation
+cheb_cur = ti.Vector.field(3, float, shape=(N*N)) # q^k
+cheb_prev = ti.Vector.field(3, float, shape=(N*N)) # q^(k-1)
+residuals = []
+
+# vertex-triangle self-collision through a spatial hash rebuilt every XPBD substep (solver 1)
+self_collision = False # costs about 2x the frame time at N = 256 on one CPU core
+thickness = 0.4 * len_edge # below the rest distance of a vertex to its non-adjacent triangles
+
 ball_center = ti.Vector.field(3, float, shape=1)
 ball_radius = 2.7
 
 @ti.kernel
-def init_scence():
+def init_grid():
     ball_center[0] = ti.Vector([5, 5, 0])
 
     for i in pos_vertex:
@@ -54,7 +93,67 @@ def init_scence():
         else:
             colors[i * N + j] = (1, 0.334, 0.52)
 
-    
+
+
+def mesh_constraints(tris, rest_pos):
+    # returns vertex pairs, rest lengths and compliances
+    e = np.sort(np.concatenate([tris[:, [0, 1]], tris[:, [1, 2]], tris[:, [2, 0]]]), axis=1)
+    opposite = np.concatenate([tris[:, 2], tris[:, 0], tris[:, 1]])
+    length = np.linalg.norm(rest_pos[e[:, 0]] - rest_pos[e[:, 1]], axis=1).reshape(3, -1)
+    longest = (length >= length.max(axis=0) * (1 - 1e-4)).ravel() # up to rounding of the rest positions
+    edges, which = np.unique(e, axis=0, return_inverse=True)
+    # the two triangles of every interior edge
+    occurrence = np.argsort(which.ravel(), kind='stable')
+    start = np.searchsorted(which.ravel()[occurrence], np.arange(len(edges)))
+    interior = np.bincount(which.ravel(), minlength=len(edges)) == 2
+    first, second = occurrence[start[interior]], occurrence[start[interior] + 1]
+    across = np.stack([opposite[first], opposite[second]], axis=1)
+    shear = longest[first] & longest[second]
+    groups = [(edges, compliance), (across[shear], compliance)]
+    if bending:
+        groups.append((across[~shear], bending_compliance))
+    pairs = np.concatenate([p for p, _ in groups])
+    rest = np.linalg.norm(rest_pos[pairs[:, 0]] - rest_pos[pairs[:, 1]], axis=1)
+    return pairs, rest, np.concatenate([np.full(len(p), c) for p, c in groups])
+
+
+def color_constraints(edges, num_vertex):
+    # greedy coloring, every constraint takes the lowest color not used at either of its vertices;
+    # returns the constraint order grouped by color and the start of every color in it
+    used = [0] * num_vertex
+    color = np.empty(len(edges), dtype=np.int32)
+    for k, (a, b) in enumerate(edges.tolist()):
+        free = ~(used[a] | used[b])
+        c = (free & -free).bit_length() - 1
+        color[k] = c
+        used[a] |= 1 << c
+        used[b] |= 1 << c
+    order = np.argsort(color, kind='stable')
+    return order, np.searchsorted(color[order], np.arange(color.max() + 2)).tolist()
+
+
+def init_scence():
+    global cons, rest_len, cons_compliance, lam, color_start, n_colors, n_free, collider
+    init_grid()
+    tris = indice.to_numpy().reshape(-1, 3)
+    pairs, rest, comp = mesh_constraints(tris, pos_vertex.to_numpy())
+    order, color_start = color_constraints(pairs, N * N)
+    n_colors = len(color_start) - 1
+    if solver == 0: # Jacobi does not need the colors, the build order keeps neighbors closer in memory
+        order = np.arange(len(pairs))
+    cons = ti.Vector.field(2, int, shape=len(pairs))
+    rest_len = ti.field(float, shape=len(pairs))
+    cons_compliance = ti.field(float, shape=len(pairs)) # inverse stiffness
+    lam = ti.field(float, shape=len(pairs)) # accumulated XPBD multipliers of the current substep
+    cons.from_numpy(pairs[order].astype(np.int32))
+    rest_len.from_numpy(rest[order].astype(np.float32))
+    cons_compliance.from_numpy(comp[order].astype(np.float32))
+    sum_cal.from_numpy(np.bincount(pairs.ravel(), minlength=N * N).astype(np.int32))
+    n_free = int((~fixed.to_numpy()[pairs].any(axis=1)).sum()) # constraints the residual measures
+    if self_collision:
+        collider = cloth_collision.SelfCollision(pos_vertex, prev_pos, fixed, tris, thickness)
+
+
 @ti.kernel
 def set_up():
     for i in vel_vertex:
@@ -65,44 +164,151 @@ def set_up():
 
 
 @ti.kernel
-def limiting():
+def limiting() -> float:
     for i in sum_x:
         sum_x[i] = ti.Vector([0, 0, 0])
-        sum_cal[i] = 0
 
-    for i in pos_vertex:
-        x = i // N
-        y = i % N
-        dx = ti.Vector([1, 0, 1, -1])
-        dy = ti.Vector([0, 1, 1, 1])
-        origin_len = ti.Vector([1, 1, ti.sqrt(2.0), ti.sqrt(2.0)])
-
-        for j in range(4):
-            new_x = x + dx[j]
-            new_y = y + dy[j]
-            if new_x>=0 and new_x<N and new_y>=0 and new_y<N:
-                new_idx = new_x * N + new_y
-                ti.atomic_add(sum_cal[new_idx], 1)
-                ti.atomic_add(sum_cal[i], 1)
-                dirc = (pos_vertex[i] - pos_vertex[new_idx]).normalized()
-                sum_x[i] += 0.5 * (pos_vertex[i] + pos_vertex[new_idx] + origin_len[j] * len_edge * dirc)
-                sum_x[new_idx] += 0.5 * (pos_vertex[i] + pos_vertex[new_idx] - origin_len[j] * len_edge * dirc)
+    res = 0.0
+    for k in cons:
+        i = cons[k][0]
+        j = cons[k][1]
+        if not fixed[i] and not fixed[j]:
+            res += ((pos_vertex[i] - pos_vertex[j]).norm() / rest_len[k] - 1) ** 2
+        dirc = (pos_vertex[i] - pos_vertex[j]).normalized()
+        sum_x[i] += 0.5 * (pos_vertex[i] + pos_vertex[j] + rest_len[k] * dirc)
+        sum_x[j] += 0.5 * (pos_vertex[i] + pos_vertex[j] - rest_len[k] * dirc)
 
     for i in pos_vertex:
         if not fixed[i]:
             new_pos = (0.2 * pos_vertex[i] + sum_x[i]) / (0.2 + sum_cal[i])
             vel_vertex[i] += (new_pos - pos_vertex[i]) / dt / substep
             pos_vertex[i] = new_pos
+    return res
+
+
+@ti.kernel
+def predict():
+    for k in lam:
+        lam[k] = 0
+    for i in vel_vertex:
+        prev_pos[i] = pos_vertex[i]
+        vel_vertex[i] *= damp ** (1 / xpbd_substeps)
+        vel_vertex[i] += ti.Vector([0, 0, -g]) * h
+        if not fixed[i]:
+            pos_vertex[i] += h * vel_vertex[i]
+
+
+@ti.func
+def inv_mass(i):
+    w = 1.0
+    if fixed[i]:
+        w = 0.0
+    return w
+
+
+@ti.kernel
+def solve_constraints() -> float: # one Gauss-Seidel sweep, color by color
+    res = 0.0
+    for c in ti.static(range(n_colors)):
+        for k in range(color_start[c], color_start[c + 1]):
+            alpha = cons_compliance[k] / (h * h)
+            i = cons[k][0]
+            j = cons[k][1]
+            w = inv_mass(i) + inv_mass(j)
+            d = pos_vertex[i] - pos_vertex[j]
+            l = d.norm()
+            if w == 2:
+                res += (l / rest_len[k] - 1) ** 2
+            if w > 0 and l > 1e-9:
+                dlam = (rest_len[k] - l - alpha * lam[k]) / (w + alpha)
+                lam[k] += dlam
+                pos_vertex[i] += inv_mass(i) * dlam / l * d
+                pos_vertex[j] -= inv_mass(j) * dlam / l * d
+    return res
+
+
+@ti.kernel
+def chebyshev_start():
+    for i in pos_vertex:
+        cheb_cur[i] = pos_vertex[i]
+        cheb_prev[i] = pos_vertex[i]
+
+
+@ti.kernel
+def chebyshev_step(omega: float, vel_scale: float):
+    # q^(k+1) = omega (gamma (hat q^(k+1) - q^k) + q^k - q^(k-1)) + q^(k-1), hat q^(k+1) being the
+    # sweep result in pos_vertex; the Jacobi solver also passes its position change to vel_vertex
+    for i in pos_vertex:
+        if not fixed[i]:
+            q = omega * (cheb_gamma * (pos_vertex[i] - cheb_cur[i]) + cheb_cur[i] - cheb_prev[i]) + cheb_prev[i]
+            vel_vertex[i] += (q - pos_vertex[i]) * vel_scale
+            cheb_prev[i] = cheb_cur[i]
+            cheb_cur[i] = q
+            pos_vertex[i] = q
+
+
+@ti.kernel
+def update_velocity(): # the ball contact is part of the position change
+    for i in pos_vertex:
+        ball_contact(i)
+        if not fixed[i]:
+            vel_vertex[i] = (pos_vertex[i] - prev_pos[i]) / h
+
+
+@ti.func
+def ball_contact(i): # pushes vertex i out of the ball, returns its displacement
+    dpos = ti.Vector([0.0, 0.0, 0.0])
+    dirc = pos_vertex[i] - ball_center[0]
+    if (dirc.norm() < 1.05*ball_radius) and (not fixed[i]):
+        new_pos = ball_center[0] + 1.05*ball_radius * dirc.normalized()
+        dpos = new_pos - pos_vertex[i]
+        pos_vertex[i] = new_pos
+    return dpos
 
 
 @ti.kernel
 def collision():
     for i in pos_vertex:
-        dirc = pos_vertex[i] - ball_center[0]
-        if (dirc.norm() < 1.05*ball_radius) and (not fixed[i]):
-            new_pos = ball_center[0] + 1.05*ball_radius * dirc.normalized()
-            vel_vertex[i] += (new_pos - pos_vertex[i]) / dt
-            pos_vertex[i] = new_pos
+        vel_vertex[i] += ball_contact(i) / dt
+
+
+def solve(sweep, iters, vel_scale):
+    # runs up to iters sweeps, returns their residuals
+    res = []
+    omega = 1.0
+    accelerate = chebyshev and iters > cheb_delay + 1
+    j = 0 # sweeps since the recurrence (re)started
+    for k in range(iters):
+        if accelerate and k == cheb_delay:
+            chebyshev_start()
+        res.append(sqrt(sweep() / n_free))
+        if res[-1] < tolerance:
+            break
+        if accelerate and cheb_delay <= k < iters - 1:
+            if k > cheb_delay and res[-1] > res[-2]:
+                j = 0 # omega = 1 takes the plain sweep and restarts from there
+            # omega_1 = 1, omega_2 = 2 / (2 - rho^2), omega_(j+1) = 4 / (4 - rho^2 omega_j)
+            omega = 1.0 if j == 0 else 2 / (2 - rho * rho) if j == 1 else 4 / (4 - rho * rho * omega)
+            j += 1
+            chebyshev_step(omega, vel_scale)
+    return res
+
+
+def step():
+    residuals.clear()
+    if solver == 1:
+        for _ in range(xpbd_substeps):
+            predict()
+            residuals.extend(solve(solve_constraints, xpbd_iters, 0.0))
+            if self_collision:
+                collider.step()
+            update_velocity()
+        return
+
+    set_up()
+    residuals.extend(solve(limiting, substep, 1 / dt / substep))
+    
+    collision()
 
 
 def main():
@@ -112,6 +318,7 @@ def main():
     canvas.set_background_color((1, 1, 1))
     scene = ti.ui.Scene()
     camera = ti.ui.Camera()
+    gui = window.get_gui()
     forward = ti.Vector([-1, 1, 0]).normalized()
     up = ti.Vector([0, 0, 1]).normalized()
     left = ti.Vector([-1, -1, 0]).normalized()
@@ -131,11 +338,10 @@ def main():
             elif window.event.key == 'e':
                 ball_center[0] -= 0.2 * up
 
-        set_up()
-        for _ in range(substep):
-            limiting()
-        
-        collision()
+        step()
+
+        with gui.sub_window("solver", 0.02, 0.02, 0.3, 0.08):
+            gui.text(f'sweeps: {len(residuals)}, stretch: {residuals[-1]:.2e}')
 
         camera.position(20.0, -10.0, 15.0)
         camera.lookat(0, 0, 0)
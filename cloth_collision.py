@@ -0,0 +1,111 @@
+import numpy as np
+import taichi as ti
+from fem_collision import closest_point
+
+# Self-collision of cloth: vertices against the triangles of the same mesh.
+# Every substep each triangle is inserted into the grid cell of its centroid, the cells
+# being hashed into a fixed size table (counting sort on the device). Cells are at least
+# twice as large as the reach of a triangle (centroid to corner plus the thickness), so a
+# vertex finds every triangle that may touch it in the 2 x 2 x 2 cells nearest to it.
+# Cloth is two-sided, so the side a vertex belongs to is taken from the positions at the
+# start of the substep and the vertex is pushed back to the thickness on that side.
+
+
+@ti.data_oriented
+class SelfCollision:
+    # pos: vertex positions after the constraint solve, prev_pos: positions at the start of the
+    # substep, fixed: pinned vertices, tris: numpy (n, 3) triangles, thickness: rest distance to them,
+    # stretch: how far triangles may stretch beyond their rest size before contacts get missed
+    def __init__(self, pos, prev_pos, fixed, tris, thickness:float, stretch:float=1.25):
+        self.pos = pos
+        self.prev_pos = prev_pos
+        self.fixed = fixed
+        self.thickness = thickness
+        self.n_tri = len(tris)
+        rest = pos.to_numpy()[tris]
+        corner = np.linalg.norm(rest - rest.mean(axis=1, keepdims=True), axis=2).max()
+        self.reach = float(stretch * corner + thickness)
+        self.cell_size = 2 * self.reach
+        self.table_size = 1 << int(np.ceil(np.log2(2 * self.n_tri)))
+        self.tri = ti.Vector.field(3, int, shape=self.n_tri)
+        self.tri.from_numpy(tris.astype(np.int32))
+        self.count = ti.field(int, shape=self.table_size)
+        self.start = ti.field(int, shape=self.table_size)
+        self.cursor = ti.field(int, shape=self.table_size)
+        # triangles sorted by cell, with their centroids alongside for a cheap rejection test
+        self.entry = ti.field(int, shape=self.n_tri)
+        self.entry_center = ti.Vector.field(3, float, shape=self.n_tri)
+        self.dpos = ti.Vector.field(3, float, shape=pos.shape)
+
+    @ti.func
+    def cell(self, p):
+        return ti.floor(p / self.cell_size, int)
+
+    @ti.func
+    def hash(self, c): # table_size is a power of two, the mask also folds negative cells
+        return ((c[0] * 73856093) ^ (c[1] * 19349663) ^ (c[2] * 83492791)) & (self.table_size - 1)
+
+    @ti.func
+    def center(self, t):
+        return (self.pos[self.tri[t][0]] + self.pos[self.tri[t][1]] + self.pos[self.tri[t][2]]) / 3
+
+    @ti.kernel
+    def build(self):
+        for h in self.count:
+            self.count[h] = 0
+        for t in self.tri:
+            ti.atomic_add(self.count[self.hash(self.cell(self.center(t)))], 1)
+        start = 0
+        ti.loop_config(serialize=True)
+        for h in range(self.table_size):
+            self.start[h] = start
+            self.cursor[h] = start
+            start += self.count[h]
+        for t in self.tri:
+            c = self.center(t)
+            k = ti.atomic_add(self.cursor[self.hash(self.cell(c))], 1)
+            self.entry[k] = t
+            self.entry_center[k] = c
+
+    @ti.kernel
+    def collide(self):
+        for v in self.pos:
+            self.dpos[v] = ti.Vector([0.0, 0.0, 0.0])
+            if not self.fixed[v]:
+                p = self.pos[v]
+                base = ti.floor(p / self.cell_size - 0.5, int) # the centroids within reach lie in base + {0, 1}^3
+                best = self.thickness
+                best_q = p
+                best_t = -1
+                for offset in ti.static(ti.grouped(ti.ndrange(2, 2, 2))):
+                    h = self.hash(base + offset)
+                    for e in range(self.start[h], self.start[h] + self.count[h]):
+                        if (p - self.entry_center[e]).norm_sqr() < self.reach * self.reach:
+                            t = self.entry[e]
+                            if self.tri[t][0] != v and self.tri[t][1] != v and self.tri[t][2] != v:
+                                q = closest_point(p, self.pos[self.tri[t][0]], self.pos[self.tri[t][1]], self.pos[self.tri[t][2]])
+                                dist = (p - q).norm()
+                                if dist < best:
+                                    best = dist
+                                    best_q = q
+                                    best_t = t
+
+                if best_t >= 0:
+                    i, j, k = self.tri[best_t][0], self.tri[best_t][1], self.tri[best_t][2]
+                    n = (self.pos[j] - self.pos[i]).cross(self.pos[k] - self.pos[i]).normalized()
+                    n0 = (self.prev_pos[j] - self.prev_pos[i]).cross(self.prev_pos[k] - self.prev_pos[i])
+                    if (self.prev_pos[v] - self.prev_pos[i]).dot(n0) < 0: # the side the vertex came from
+                        n = -n
+                    side = (p - best_q).dot(n)
+                    if side < self.thickness: # closer than the thickness or crossed over
+                        self.dpos[v] = (self.thickness - side) * n
+
+    @ti.kernel
+    def apply(self): # corrections are applied after all vertices read consistent positions
+        for v in self.pos:
+            self.pos[v] += self.dpos[v]
+
+    def step(self):
+        self.build()
+        self.collide()
+        self.apply()
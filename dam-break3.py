@@ -3,10 +3,13 @@ import taichi.math as tm
 import numpy as np
 import math
 import time
+import sdf_boundary
+import scene_builder
 
 ti.init(arch=ti.gpu)
 show_type = 0
 visualization = 1
+boundary_mode = 0 # 0: wall particles, 1: precomputed density map
 
 # parameters
 h = 3.0
@@ -26,6 +29,8 @@ wallNumX = int(boundX // wall_gap) - 4
 wallNumY = int(boundY // wall_gap) - 4
 wallNumZ = int((boundZ/3) // wall_gap) - 4
 wallNum = wallNumX * wallNumY * wall_layer  + (wallNumZ - wall_layer) * wallNumX * 2 * wall_layer + (wallNumZ - wall_layer) * (wallNumY - 2 * wall_layer) * 2 * wall_layer
+if boundary_mode == 1:
+    wallNum = 0
 rho_wall = 1000.0
 
 fluid_n = 36000
@@ -62,6 +67,20 @@ Particles = ti.field(int, shape = (numCellX, numCellY, numCellZ, 4000))
 NeiNum = ti.field(int, shape = fluid_n)
 neighbor = ti.field(int, shape = (fluid_n, 1000))
 
+# scene
+scene = scene_builder.cached(scene_builder.dam_break, blocks=[[0.1*boundX, 0.1*boundY, 6.0], [0.5*boundX, 0.5*boundY, 6.0], [0.1*boundX, 0.5*boundY, 6.0]],
+                             count=fluid_n, num=20, dis=particle_distance, wall_num=[wallNumX, wallNumY, wallNumZ],
+                             wall_layer=wall_layer, wall_gap=wall_gap, walls=boundary_mode == 0)
+assert len(scene['fluid']) == fluid_n and len(scene['wall']) == wallNum
+
+# boundary map
+bmap = None
+if boundary_mode == 1:
+    wall_top = (wallNumZ + 0.5) * wall_gap
+    bmap = sdf_boundary.OpenBox(inner_lo=[(wall_layer + 0.5) * wall_gap] * 3,
+                                inner_hi=[(wallNumX - wall_layer + 0.5) * wall_gap, (wallNumY - wall_layer + 0.5) * wall_gap, wall_top],
+                                thickness=wall_layer * wall_gap, top=wall_top, dx=wall_gap, h=h, n=1.0 / wall_gap**3, sample_dx=0.5 * wall_gap)
+
 # rendering
 palette = ti.Vector.field(3, float, shape = fluid_n)
 render_pos = ti.Vector.field(3, float, shape = fluid_n)
@@ -175,63 +194,11 @@ def init():
     rho_0[1] = 700.0
     rho_0[2] = 400.0
     g[0] = ti.Vector([0.0, 0.0, -9.8])
-    mid = fluid_n / 3
-    num = 20
-
-    for i in range(mid):
-        posz = (i // (num * num)) * particle_distance
-        plane = i % (num * num)
-        posx = (plane % num) * particle_distance
-        posy = (plane // num) * particle_distance
-        pos[i] = ti.Vector([0.1*boundX + posx, 0.1*boundY + posy, 6.0 + posz])
-        alpha[i, 0] = 1.0
-        alpha[i, 1] = 0.0
-        alpha[i, 2] = 0.0
-
-    for i in range(mid, 2*mid):
-        j = i - mid
-        posz = (j // (num * num)) * particle_distance
-        plane = j % (num * num)
-        posx = (plane % num) * particle_distance
-        posy = (plane // num) * particle_distance
-        pos[i] = ti.Vector([0.5*boundX + posx, 0.5*boundY + posy, 6.0 + posz])
-        alpha[i, 0] = 0.0
-        alpha[i, 1] = 1.0
-        alpha[i, 2] = 0.0
-    
-    for i in range(2*mid, 3*mid):
-        j = i - 2 * mid
-        posz = (j // (num * num)) * particle_distance
-        plane = j % (num * num)
-        posx = (plane % num) * particle_distance
-        posy = (plane // num) * particle_distance
-        pos[i] = ti.Vector([0.1*boundX + posx, 0.5*boundY + posy, 6.0 + posz])
-        alpha[i, 0] = 0.0
-        alpha[i, 1] = 0.0
-        alpha[i, 2] = 1.0
-    
-    cur_idx = fluid_n
-    for i, j, k in ti.ndrange(wallNumX, wallNumY, wall_layer): # floor
-        temp_idx = ti.atomic_add(cur_idx, 1)
-        pos[temp_idx] = ti.Vector([(i+1)*wall_gap, (j+1)*wall_gap, (k+1)*wall_gap])
-    
-    for i, j, k in ti.ndrange(wallNumX, wall_layer, (wall_layer, wallNumZ)): # wall
-        temp_idx = ti.atomic_add(cur_idx, 1)
-        pos[temp_idx] = ti.Vector([(i+1)*wall_gap, (j+1)*wall_gap, (k+1)*wall_gap])
-    
-    for i, j, k in ti.ndrange(wallNumX, (wallNumY-wall_layer, wallNumY), (wall_layer, wallNumZ)): # wall
-        temp_idx = ti.atomic_add(cur_idx, 1)
-        pos[temp_idx] = ti.Vector([(i+1)*wall_gap, (j+1)*wall_gap, (k+1)*wall_gap])
-    
-    for i, j, k in ti.ndrange(wall_layer, (wall_layer, wallNumY-wall_layer), (wall_layer, wallNumZ)): # wall
-        temp_idx = ti.atomic_add(cur_idx, 1)
-        pos[temp_idx] = ti.Vector([(i+1)*wall_gap, (j+1)*wall_gap, (k+1)*wall_gap])
-
-    for i, j, k in ti.ndrange((wallNumX-wall_layer, wallNumX), (wall_layer, wallNumY-wall_layer), (wall_layer, wallNumZ)): # wall
-        temp_idx = ti.atomic_add(cur_idx, 1)
-        pos[temp_idx] = ti.Vector([(i+1)*wall_gap, (j+1)*wall_gap, (k+1)*wall_gap])
-
-    assert(cur_idx == fluid_n + wallNum)
+    mid = fluid_n // 3
+    for i in range(fluid_n):
+        for ph in ti.static(range(phase)):
+            alpha[i, ph] = 0.0
+        alpha[i, ti.min(i // mid, phase - 1)] = 1.0
 
 @ti.kernel
 def cal_press():
@@ -249,6 +216,9 @@ def cal_press():
             else: # Wall
                 rho_bar[i] += rho_wall * W((pos[i] - pos[j]).norm())
 
+        if ti.static(boundary_mode == 1):
+            rho_bar[i] += rho_wall * bmap.density(pos[i])
+
         if rho_bar[i] < 1e-6:
             rho_bar[i] = rho_m[i]
     
@@ -352,6 +322,9 @@ def cal_acc():
             else: # Wall
                 prs_grad += rho_wall * (prs[i] + prs[i]) / (2 * rho_0[0]) * DW(pos[i] - pos[j])
 
+        if ti.static(boundary_mode == 1):
+            prs_grad += rho_wall * prs[i] / rho_0[0] * bmap.gradient(pos[i])
+
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
             if j < fluid_n:
@@ -387,7 +360,10 @@ def pre_render():
 
 
 if __name__ == '__main__':
+    pos.from_numpy(np.concatenate([scene['fluid'], scene['wall']]))
     init()
+    if boundary_mode == 1:
+        bmap.build()
     gui = ti.ui.Window('SPH', res = (700, 700))
     canvas = gui.get_canvas()
     canvas.set_background_color((1, 1, 1))
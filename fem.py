@@ -1,17 +1,65 @@
 import taichi as ti
+import numpy as np
 import meshio
+import fem_io
+import fem_collision
 
 ti.init(arch=ti.gpu)
 
 g = ti.Vector([0, 0, -9.8])
 Young = 5000
 Poisson = 0.3
-miu = Young / (2 + 2 * Poisson)
-lam = Young * Poisson / ((1 + Poisson) * (1 - 2 * Poisson))
 dt = 0.001
 damp = 0.9999
 m = 1
 
+
+def instance(mesh, translate=(0.0, 0.0, 20.0), rotate=0.0, scale=1.0, Young=Young, Poisson=Poisson, mass=m):
+    # one copy of mesh, rotated by rotate degrees about z and scaled about the mesh origin, then translated;
+    # mass is per vertex
+    return dict(mesh=mesh, translate=translate, rotate=rotate, scale=scale, Young=Young, Poisson=Poisson, mass=mass)
+
+
+# all instances are packed into the same fields and advanced by the same launches,
+# e.g. a row of penguins getting stiffer to the right:
+# instances = [instance("penguin.msh", translate=(3.0 * k, 0.0, 20.0), rotate=30.0 * k, Young=5000 * 2 ** k) for k in range(8)]
+instances = [instance("penguin.msh")]
+
+# 0: explicit, steps_per_frame steps of dt per output frame
+# 1: backward Euler linearized at the start of the step (one Newton iteration),
+#    solved matrix-free with Jacobi preconditioned CG
+integrator = 0
+steps_per_frame = 20
+frame_dt = steps_per_frame * dt
+launch_substeps = 10 # explicit substeps unrolled into one advance_substeps() launch (collision = 0 only), compile time grows with it
+assert steps_per_frame % launch_substeps == 0
+implicit_substeps = 1
+dt_implicit = frame_dt / implicit_substeps
+cg_iters = 100
+cg_tol = 1e-4 # relative residual
+
+# 0: tetrahedra scatter their vertex forces with atomic adds
+# 1: tetrahedra store their vertex forces, every vertex then sums those of its incident
+#    tetrahedra (CSR adjacency) in a fixed order, so results are bitwise reproducible
+force_mode = 1
+
+# 0: one VTK file per frame
+# 1: XDMF time series, connectivity written once and positions appended per frame
+#    by a background thread
+output_mode = 0
+
+# 0: vertices and tets in file order
+# 1: vertices renumbered along a Hilbert curve and tets sorted by their lowest vertex,
+#    so neighboring threads touch nearby memory; output is mapped back to file order
+reorder = 1
+
+# 0: ground plane only
+# 1: also BVH contact of the surface against a static ramp and between the bodies
+#    (connected components) of the mesh; contacts are resolved between substeps, so the
+#    explicit integrator then launches every substep on its own instead of advance_substeps()
+collision = 0
+contact_thickness = 0.25 # fraction of the mean surface edge length
+
 @ti.func
 def contain(tet, p):
     res = 0
@@ -23,27 +71,91 @@ def contain(tet, p):
     return res
 
 
+def vertex_tets(cells, num_point):
+    # CSR adjacency: the tetrahedra of vertex v are vt_entry[vt_start[v]:vt_start[v + 1]],
+    # stored as tet * 4 + corner in increasing tet order
+    flat = cells.ravel()
+    entry = np.argsort(flat, kind='stable')
+    start = np.zeros(num_point + 1, dtype=np.int32)
+    np.cumsum(np.bincount(flat, minlength=num_point), out=start[1:])
+    return start, entry.astype(np.int32)
+
+
+@ti.func
+def deposit(dst: ti.template(), i, k: ti.template(), f): # contribution f of tet i to its corner k
+    if ti.static(force_mode == 1):
+        tet_f[i, k] = f
+    else:
+        dst[tetra[i][k]] += f
+
+
+@ti.func
+def gather(v): # sum of the contributions deposited on vertex v
+    res = ti.Vector([0.0, 0.0, 0.0])
+    for e in range(vt_start[v], vt_start[v + 1]):
+        res += tet_f[vt_entry[e] // 4, vt_entry[e] % 4]
+    return res
+
+
 @ti.kernel
 def init():
     for i in range(NumPoint):
-        pos[i] += ti.Vector([0.0, 0.0, 20.0])
         vel[i] = ti.Vector([0.0, 0.0, 0.0])
         acc[i] = ti.Vector([0.0, 0.0, 0.0])
-    
-    for i in range(NumTetra):
-        dm1 = pos[tetra[i][1]] - pos[tetra[i][0]]
-        dm2 = pos[tetra[i][2]] - pos[tetra[i][0]]
-        dm3 = pos[tetra[i][3]] - pos[tetra[i][0]]
-        Dm = ti.Matrix.cols([dm1, dm2, dm3])
-        Dm_inv[i] = Dm.inverse()
-        volume[i] = Dm.determinant() / 6
 
 
-@ti.kernel
-def update():
-    for i in acc:
-        acc[i] = ti.Vector([0.0, 0.0, 0.0])
+def rest_state(points, cells):
+    # inverse edge matrix and volume of every tetrahedron, cached with the mesh after the first run
+    X = points[cells].astype(np.float64)
+    Dm = np.stack([X[:, 1] - X[:, 0], X[:, 2] - X[:, 0], X[:, 3] - X[:, 0]], axis=2)
+    return np.linalg.inv(Dm).astype(np.float32), (np.linalg.det(Dm) / 6).astype(np.float32)
+
+
+def load_instance_mesh(path):
+    # file order mesh, its renumbering and the renumbered rest state, shared by all instances of it
+    mesh, mesh_cache = fem_io.load_mesh(path)
+    points, cells = mesh['points'], mesh['tetra']
+    if 'Dm_inv' in mesh: # cached in file order
+        rest_Dm_inv, rest_volume = mesh['Dm_inv'], mesh['volume']
+    else:
+        rest_Dm_inv, rest_volume = rest_state(points, cells)
+        fem_io.store_mesh(mesh_cache, Dm_inv=rest_Dm_inv, volume=rest_volume)
+    if reorder == 1:
+        vert_order, tet_order = fem_io.hilbert_order(points, cells) # new -> file index
+    else:
+        vert_order, tet_order = np.arange(len(points)), np.arange(len(cells))
+    return dict(points=points, cells=cells, vert_order=vert_order, tets=fem_io.renumber(cells, vert_order, tet_order),
+                Dm_inv=rest_Dm_inv[tet_order], volume=rest_volume[tet_order])
 
+
+def pack_instances(instances):
+    # concatenates the instances in renumbered order; vertex and tet ranges of instance k start
+    # at point_start[k] and tet_start[k]
+    meshes = {}
+    parts = []
+    for inst in instances:
+        if inst['mesh'] not in meshes:
+            meshes[inst['mesh']] = load_instance_mesh(inst['mesh'])
+        mesh = meshes[inst['mesh']]
+        c, s = np.cos(np.radians(inst['rotate'])), np.sin(np.radians(inst['rotate']))
+        A = inst['scale'] * np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]) # Dm -> A Dm
+        parts.append(dict(points=mesh['points'][mesh['vert_order']] @ A.T + inst['translate'],
+                          tets=mesh['tets'], cells=mesh['cells'], vert_order=mesh['vert_order'],
+                          Dm_inv=mesh['Dm_inv'] @ np.linalg.inv(A), volume=mesh['volume'] * np.linalg.det(A)))
+    point_start = np.cumsum([0] + [len(p['points']) for p in parts])
+    tet_start = np.cumsum([0] + [len(p['tets']) for p in parts])
+    cat = lambda key, dtype, shift=None: np.concatenate(
+        [p[key] + (0 if shift is None else shift[k]) for k, p in enumerate(parts)]).astype(dtype)
+    return dict(points=cat('points', np.float32), tets=cat('tets', np.int32, point_start),
+                cells=cat('cells', np.int32, point_start), vert_order=cat('vert_order', np.int64, point_start),
+                Dm_inv=cat('Dm_inv', np.float32), volume=cat('volume', np.float32),
+                vert_inst=np.repeat(np.arange(len(parts)), np.diff(point_start)).astype(np.int32),
+                tet_inst=np.repeat(np.arange(len(parts)), np.diff(tet_start)).astype(np.int32),
+                point_start=point_start, tet_start=tet_start)
+
+
+@ti.func
+def compute_forces(): # deposits f / m of every tet on its corners
     for i in range(NumTetra):
         p0 = tetra[i][0]
         p1 = tetra[i][1]
@@ -56,11 +168,12 @@ def update():
         Ds = ti.Matrix.cols([ds1, ds2, ds3])
 
         eye3 = ti.Matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        k = tet_inst[i]
         F = Ds @ Dm_inv[i]
         G = 0.5 * (((F.transpose()) @ F) - eye3)
         # if contain(i, 2):
             # print("G:", G)
-        P = F @ (2.0 * miu * G + lam * (G.trace() * eye3))
+        P = F @ (2.0 * inst_miu[k] * G + inst_lam[k] * (G.trace() * eye3))
         # if contain(i, 2):
             # print("P:", P)
         force = -volume[i] * (P @ (Dm_inv[i].transpose()))
@@ -71,38 +184,268 @@ def update():
         # if contain(i, 2):
             # print("f0:", f0)
 
-        acc[p0] += f0 / m        
-        acc[p1] += f1 / m        
-        acc[p2] += f2 / m        
-        acc[p3] += f3 / m  
+        deposit(acc, i, 0, f0 / inst_m[k])
+        deposit(acc, i, 1, f1 / inst_m[k])
+        deposit(acc, i, 2, f2 / inst_m[k])
+        deposit(acc, i, 3, f3 / inst_m[k])
 
 
 @ti.kernel
-def advance():
+def update():
+    if ti.static(force_mode == 0):
+        for i in acc:
+            acc[i] = ti.Vector([0.0, 0.0, 0.0])
+
+    compute_forces()
+
+    if ti.static(force_mode == 1):
+        for i in acc:
+            acc[i] = gather(i)
+
+
+@ti.func
+def ground(i):
+    if pos[i][2] < 0 :
+        pos[i][2] = -pos[i][2]
+        if vel[i][2] < 0 :
+            vel[i][2] = -0.8 * vel[i][2]
+
+
+@ti.func
+def integrate(i, a):
+    vel[i] += (a + g) * dt
+    vel[i] *= damp
+    pos[i] += vel[i] * dt
+
+    ground(i)
+    # vel[i] += (a + g) * dt * damp
+    # if pos[i][2] < 0 and vel[i][2] < 0 :
+    #     vel[i][2] = 0
+    
+    # pos[i] += vel[i] * dt
+
+
+@ti.func
+def substep_body():
+    # one explicit substep in two loops, every vertex gathers its force and integrates in the
+    # same pass. With force_mode 0 acc must be zero on entry, which init() and every substep
+    # leave it. substep() (collision = 1, contacts between substeps) and advance_substeps()
+    # are the two explicit paths
+    compute_forces()
     for i in pos:
-        vel[i] += (acc[i] + g) * dt
-        vel[i] *= damp
-        pos[i] += vel[i] * dt
+        if ti.static(force_mode == 1):
+            integrate(i, gather(i))
+        else:
+            integrate(i, acc[i])
+            acc[i] = ti.Vector([0.0, 0.0, 0.0])
+
+
+@ti.kernel
+def substep():
+    substep_body()
+
+
+@ti.kernel
+def advance_substeps(): # launch_substeps explicit substeps in one launch
+    for _ in ti.static(range(launch_substeps)):
+        substep_body()
+
+
+@ti.func
+def deformation_gradient(i):
+    p0 = tetra[i][0]
+    Ds = ti.Matrix.cols([pos[tetra[i][1]] - pos[p0], pos[tetra[i][2]] - pos[p0], pos[tetra[i][3]] - pos[p0]])
+    return Ds @ Dm_inv[i]
+
 
-        if pos[i][2] < 0 :
-            pos[i][2] = -pos[i][2]
-            if vel[i][2] < 0 :
+@ti.func
+def clamped_stress(i, F):
+    # second Piola-Kirchhoff stress without its compressive eigenvalues; the dF S term of the
+    # tangent is indefinite under compression, clamping keeps M - h^2 K positive definite
+    eye3 = ti.Matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    G = 0.5 * (((F.transpose()) @ F) - eye3)
+    k = tet_inst[i]
+    U, sig, V = ti.svd(2.0 * inst_miu[k] * G + inst_lam[k] * (G.trace() * eye3))
+    res = ti.Matrix.zero(float, 3, 3)
+    for k in ti.static(range(3)): # S is symmetric, its eigenvalues are sig * (u . v)
+        u = ti.Vector([U[0, k], U[1, k], U[2, k]])
+        v = ti.Vector([V[0, k], V[1, k], V[2, k]])
+        res += ti.max(sig[k, k] * u.dot(v), 0.0) * u.outer_product(u)
+    return res
+
+
+@ti.func
+def force_differential(i, F, S, dDs):
+    # change of the forces on p1..p3 (columns) when the edge matrix Ds changes by dDs
+    eye3 = ti.Matrix([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    dF = dDs @ Dm_inv[i]
+    dG = 0.5 * (dF.transpose() @ F + F.transpose() @ dF)
+    k = tet_inst[i]
+    dP = dF @ S + F @ (2.0 * inst_miu[k] * dG + inst_lam[k] * (dG.trace() * eye3))
+    return -volume[i] * (dP @ (Dm_inv[i].transpose()))
+
+
+@ti.kernel
+def mul_K(src: ti.template()): # df = K src, K = d(force)/d(pos) at the current positions
+    if ti.static(force_mode == 0):
+        for i in df:
+            df[i] = ti.Vector([0.0, 0.0, 0.0])
+
+    for i in range(NumTetra):
+        p0 = tetra[i][0]
+        dDs = ti.Matrix.cols([src[tetra[i][1]] - src[p0], src[tetra[i][2]] - src[p0], src[tetra[i][3]] - src[p0]])
+        F = deformation_gradient(i)
+        dH = force_differential(i, F, clamped_stress(i, F), dDs)
+        deposit(df, i, 0, -dH @ ti.Vector([1.0, 1.0, 1.0]))
+        for k in ti.static(range(3)):
+            deposit(df, i, k + 1, ti.Vector([dH[0, k], dH[1, k], dH[2, k]]))
+
+    if ti.static(force_mode == 1):
+        for i in df:
+            df[i] = gather(i)
+
+
+@ti.kernel
+def build_system():
+    # (M - h^2 K) dv = h (f + M g) + h^2 K v, expects acc = f / m from update() and df = K v from mul_K(vel)
+    h = dt_implicit
+    for i in diag:
+        mass = inst_m[vert_inst[i]]
+        diag[i] = ti.Vector([mass, mass, mass])
+        cg_b[i] = h * mass * (acc[i] + g) + h * h * df[i]
+
+    for i in range(NumTetra):
+        # diagonal of K in closed form: a unit displacement e_d of vertex k gives dF = e_d b_k^T,
+        # b_k being the shape function gradient, and f = F^T e_d is row d of F
+        F = deformation_gradient(i)
+        S = clamped_stress(i, F)
+        B = Dm_inv[i].transpose()
+        miu, lam = inst_miu[tet_inst[i]], inst_lam[tet_inst[i]]
+        for k in ti.static(range(4)):
+            b = -B @ ti.Vector([1.0, 1.0, 1.0])
+            if ti.static(k > 0):
+                b = ti.Vector([B[0, k - 1], B[1, k - 1], B[2, k - 1]])
+            k_diag = ti.Vector([0.0, 0.0, 0.0])
+            for d in ti.static(range(3)):
+                f = ti.Vector([F[d, 0], F[d, 1], F[d, 2]])
+                fb = f.dot(b)
+                k_diag[d] = -volume[i] * (b.dot(S @ b) + miu * (fb * fb + f.dot(f) * b.dot(b)) + lam * fb * fb)
+            deposit(diag, i, k, -h * h * k_diag)
+
+    if ti.static(force_mode == 1):
+        for i in diag:
+            diag[i] += gather(i)
+
+
+@ti.kernel
+def cg_init() -> float:
+    rz = 0.0
+    for i in cg_r:
+        dv[i] = ti.Vector([0.0, 0.0, 0.0])
+        cg_r[i] = cg_b[i]
+        cg_z[i] = cg_r[i] / diag[i]
+        cg_p[i] = cg_z[i]
+        rz += cg_r[i].dot(cg_z[i])
+    return rz
+
+
+@ti.kernel
+def cg_mul_A() -> float: # Ap = (M - h^2 K) p from df = K p, returns p.Ap
+    res = 0.0
+    for i in cg_Ap:
+        cg_Ap[i] = inst_m[vert_inst[i]] * cg_p[i] - dt_implicit * dt_implicit * df[i]
+        res += cg_p[i].dot(cg_Ap[i])
+    return res
+
+
+@ti.kernel
+def cg_step(alpha: float) -> float: # returns r.r
+    res = 0.0
+    for i in cg_r:
+        dv[i] += alpha * cg_p[i]
+        cg_r[i] -= alpha * cg_Ap[i]
+        cg_z[i] = cg_r[i] / diag[i]
+        res += cg_r[i].dot(cg_r[i])
+    return res
+
+
+@ti.kernel
+def cg_dot_rz() -> float:
+    res = 0.0
+    for i in cg_r:
+        res += cg_r[i].dot(cg_z[i])
+    return res
+
+
+@ti.kernel
+def cg_direction(beta: float):
+    for i in cg_p:
+        cg_p[i] = cg_z[i] + beta * cg_p[i]
+
+
+@ti.kernel
+def cg_bb() -> float:
+    res = 0.0
+    for i in cg_b:
+        res += cg_b[i].dot(cg_b[i])
+    return res
+
+
+@ti.kernel
+def implicit_advance():
+    for i in pos:
+        vel[i] += dv[i]
+        pos[i] += vel[i] * dt_implicit
+        if pos[i][2] < 0: # mirroring a whole large step of penetration would inject energy, project instead
+            pos[i][2] = 0
+            if vel[i][2] < 0:
                 vel[i][2] = -0.8 * vel[i][2]
-        # vel[i] += (acc[i] + g) * dt * damp
-        # if pos[i][2] < 0 and vel[i][2] < 0 :
-        #     vel[i][2] = 0
-        
-        # pos[i] += vel[i] * dt
+
+
+def implicit_step() -> int:
+    update()
+    mul_K(vel)
+    build_system()
+    bb = cg_bb()
+    rz = cg_init()
+    it = 0
+    while it < cg_iters and rz > 0:
+        mul_K(cg_p)
+        pAp = cg_mul_A()
+        if pAp <= 0:
+            break
+        alpha = rz / pAp
+        rr = cg_step(alpha)
+        it += 1
+        if rr <= cg_tol * cg_tol * bb:
+            break
+        rz_new = cg_dot_rz()
+        cg_direction(rz_new / rz)
+        rz = rz_new
+    implicit_advance()
+    return it
+
+
+def ramp_obstacle(lo, hi, angle=25.0):
+    # two triangles tilted about the x axis, halfway between the body and the ground
+    c = 0.5 * (lo + hi)
+    half = hi[:2] - lo[:2]
+    slope = np.tan(np.radians(angle))
+    corners = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+    verts = np.array([[c[0] + sx * half[0], c[1] + sy * half[1], 0.5 * lo[2] + slope * sy * half[1]] for sx, sy in corners])
+    return verts, np.array([[0, 1, 2], [0, 2, 3]])
 
 
 if __name__ == "__main__":
     # initiate
-    mesh = meshio.read("penguin.msh")
-    points = mesh.points
-    cells = mesh.cells_dict['tetra']
-    NumPoint = len(points)
-    NumTetra = len(cells)
-    print(points.min(axis=0))
+    packed = pack_instances(instances)
+    cells = packed['cells'] # file order connectivity of all instances, for output
+    tets = packed['tets']
+    vert_order = packed['vert_order'] # new -> file index
+    NumInstance = len(instances)
+    NumPoint = len(packed['points'])
+    NumTetra = len(tets)
+    print(packed['points'].min(axis=0))
     # print(NumPoint, NumTetra)
 
     pos = ti.Vector.field(3, float, shape = NumPoint)
@@ -113,19 +456,83 @@ if __name__ == "__main__":
     volume = ti.field(float, shape = NumTetra) # initial volume of tetrahedron
     tetra = ti.Vector.field(4, int, shape = NumTetra)
 
-    pos.from_numpy(points)
-    tetra.from_numpy(cells)
+    # per instance material, looked up through the instance of every vertex and tet
+    inst_miu = ti.field(float, shape = NumInstance)
+    inst_lam = ti.field(float, shape = NumInstance)
+    inst_m = ti.field(float, shape = NumInstance)
+    vert_inst = ti.field(int, shape = NumPoint)
+    tet_inst = ti.field(int, shape = NumTetra)
+
+    # vertex to tetrahedron adjacency for force_mode 1
+    vt_start = ti.field(int, shape = NumPoint + 1)
+    vt_entry = ti.field(int, shape = 4 * NumTetra)
+    tet_f = ti.Vector.field(3, float, shape = (NumTetra, 4)) # per corner contributions
+
+    # implicit integrator state
+    dv = ti.Vector.field(3, float, shape = NumPoint)
+    df = ti.Vector.field(3, float, shape = NumPoint)
+    diag = ti.Vector.field(3, float, shape = NumPoint)
+    cg_b = ti.Vector.field(3, float, shape = NumPoint)
+    cg_r = ti.Vector.field(3, float, shape = NumPoint)
+    cg_z = ti.Vector.field(3, float, shape = NumPoint)
+    cg_p = ti.Vector.field(3, float, shape = NumPoint)
+    cg_Ap = ti.Vector.field(3, float, shape = NumPoint)
+
+    pos.from_numpy(packed['points'])
+    tetra.from_numpy(tets)
+    Dm_inv.from_numpy(packed['Dm_inv'])
+    volume.from_numpy(packed['volume'])
+    vert_inst.from_numpy(packed['vert_inst'])
+    tet_inst.from_numpy(packed['tet_inst'])
+    for k, inst in enumerate(instances):
+        assert inst['scale'] > 0
+        inst_miu[k] = inst['Young'] / (2 + 2 * inst['Poisson'])
+        inst_lam[k] = inst['Young'] * inst['Poisson'] / ((1 + inst['Poisson']) * (1 - 2 * inst['Poisson']))
+        inst_m[k] = inst['mass']
+    start, entry = vertex_tets(tets, NumPoint)
+    vt_start.from_numpy(start)
+    vt_entry.from_numpy(entry)
     init()
 
+    if collision == 1:
+        # instances share no vertices, so every instance is at least one body
+        surface = fem_collision.surface_triangles(packed['points'], tets)
+        rest = pos.to_numpy()
+        edge = np.linalg.norm(rest[surface] - rest[np.roll(surface, 1, axis=1)], axis=2).mean()
+        ramp_verts, ramp_tris = ramp_obstacle(rest.min(axis=0), rest.max(axis=0))
+        collider = fem_collision.Collider(pos, vel, fem_collision.connected_bodies(tets, NumPoint), surface,
+                                          ramp_verts, ramp_tris, contact_thickness * edge)
+
+    def file_order(x):
+        res = np.empty_like(x)
+        res[vert_order] = x
+        return res
+
+    if output_mode == 1:
+        writer = fem_io.SeriesWriter("out_fem", "penguin", cells, frame_dt)
 
     for i in range(1000):
-        for _ in range(20):
-            # print(i, _)
-            # print(i, acc.to_numpy().max(axis=0))
-            # print(acc.to_numpy().argmax(axis=0))
-            update()
-            advance()
-        
-        cur_mesh = meshio.Mesh(pos.to_numpy(), [("tetra", cells)])
-        cur_mesh.write(f"out_fem/change{i}.vtk")
+        if integrator == 1:
+            for _ in range(implicit_substeps):
+                implicit_step()
+                if collision == 1:
+                    collider.step()
+        elif collision == 1: # contacts are resolved between substeps
+            for _ in range(steps_per_frame):
+                # print(i, _)
+                # print(i, acc.to_numpy().max(axis=0))
+                # print(acc.to_numpy().argmax(axis=0))
+                substep()
+                collider.step()
+        else:
+            for _ in range(steps_per_frame // launch_substeps):
+                advance_substeps()
         
+        if output_mode == 1:
+            writer.write(file_order(pos.to_numpy()))
+        else:
+            cur_mesh = meshio.Mesh(file_order(pos.to_numpy()), [("tetra", cells)])
+            cur_mesh.write(f"out_fem/change{i}.vtk")
+
+    if output_mode == 1:
+        writer.close()
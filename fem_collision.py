@@ -0,0 +1,311 @@
+import numpy as np
+import taichi as ti
+
+# Contact of FEM soft bodies with static triangle meshes and with each other.
+# The boundary triangles of all bodies and the static triangles share one linear BVH
+# (Karras 2012): leaves are ordered by the Morton code of the triangle centroids, the
+# topology is rebuilt every few substeps and the boxes are refit bottom-up every substep.
+# Surface vertices are then pushed out of the triangles of every other body.
+
+
+def surface_triangles(points, tetra) -> np.ndarray:
+    # faces used by exactly one tet, wound so their normal points out of it
+    corner = [[1, 2, 3], [0, 3, 2], [0, 1, 3], [0, 2, 1]]
+    faces = np.concatenate([tetra[:, c] for c in corner])
+    opposite = np.concatenate([tetra[:, k] for k in range(4)])
+    _, first, count = np.unique(np.sort(faces, axis=1), axis=0, return_index=True, return_counts=True)
+    keep = first[count == 1]
+    faces, opposite = faces[keep], opposite[keep]
+    a, b, c = points[faces[:, 0]], points[faces[:, 1]], points[faces[:, 2]]
+    inward = np.einsum('ij,ij->i', np.cross(b - a, c - a), points[opposite] - a) > 0
+    faces[inward] = faces[inward][:, [0, 2, 1]]
+    return faces.astype(np.int32)
+
+
+def connected_bodies(tetra, num_point) -> np.ndarray:
+    # label every vertex with the connected component of the mesh it belongs to
+    label = np.arange(num_point)
+    while True:
+        new = label.copy()
+        np.minimum.at(new, tetra, label[tetra].min(axis=1)[:, None])
+        new = new[new] # pointer jumping
+        if np.array_equal(new, label):
+            break
+        label = new
+    return np.unique(label, return_inverse=True)[1].astype(np.int32)
+
+
+@ti.func
+def expand_bits(v):
+    # spread the low 10 bits of v so that two zero bits separate each of them
+    v = (v * ti.u32(0x00010001)) & ti.u32(0xFF0000FF)
+    v = (v * ti.u32(0x00000101)) & ti.u32(0x0F00F00F)
+    v = (v * ti.u32(0x00000011)) & ti.u32(0xC30C30C3)
+    v = (v * ti.u32(0x00000005)) & ti.u32(0x49249249)
+    return v
+
+
+@ti.func
+def closest_point(p, a, b, c):
+    # closest point to p on triangle abc (Ericson, Real-Time Collision Detection 5.1.5)
+    ab = b - a
+    ac = c - a
+    ap = p - a
+    d1 = ab.dot(ap)
+    d2 = ac.dot(ap)
+    bp = p - b
+    d3 = ab.dot(bp)
+    d4 = ac.dot(bp)
+    cp = p - c
+    d5 = ab.dot(cp)
+    d6 = ac.dot(cp)
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+    res = a
+    if d1 <= 0 and d2 <= 0:
+        res = a
+    elif d3 >= 0 and d4 <= d3:
+        res = b
+    elif d6 >= 0 and d5 <= d6:
+        res = c
+    elif vc <= 0 and d1 >= 0 and d3 <= 0:
+        res = a + d1 / (d1 - d3) * ab
+    elif vb <= 0 and d2 >= 0 and d6 <= 0:
+        res = a + d2 / (d2 - d6) * ac
+    elif va <= 0 and d4 - d3 >= 0 and d5 - d6 >= 0:
+        res = b + (d4 - d3) / ((d4 - d3) + (d5 - d6)) * (c - b)
+    else:
+        denom = 1.0 / (va + vb + vc)
+        res = a + ab * (vb * denom) + ac * (vc * denom)
+    return res
+
+
+@ti.data_oriented
+class Collider:
+    # pos/vel: vertex fields of the soft bodies, body: numpy body id per vertex
+    # tris: surface triangles of the bodies (indices into pos), static_verts/static_tris: obstacles
+    def __init__(self, pos, vel, body, tris, static_verts, static_tris, thickness:float, friction:float=0.3, rebuild_interval:int=10):
+        self.pos = pos
+        self.vel = vel
+        self.n_dyn = pos.shape[0]
+        self.thickness = thickness
+        self.friction = friction
+        self.rebuild_interval = rebuild_interval
+        self.steps = 0
+
+        static_verts = np.asarray(static_verts, dtype=np.float32).reshape(-1, 3)
+        static_tris = np.asarray(static_tris, dtype=np.int32).reshape(-1, 3)
+        all_tris = np.concatenate([tris, static_tris + self.n_dyn]).astype(np.int32)
+        tri_body = np.concatenate([body[tris[:, 0]], -np.ones(len(static_tris), dtype=np.int32)]).astype(np.int32)
+        query = np.unique(tris).astype(np.int32)
+        self.n = len(all_tris)
+        assert self.n >= 2
+        # the prefix length of the 30 bit codes (ties broken by index) grows by at least one per level,
+        # so a traversal that pushes both children never holds more than depth + 1 nodes
+        self.stack_size = 32 + int(np.ceil(np.log2(self.n)))
+
+        self.static_pos = ti.Vector.field(3, float, max(len(static_verts), 1))
+        self.tri = ti.Vector.field(3, int, self.n)
+        self.tri_body = ti.field(int, self.n) # -1 for static triangles
+        self.body = ti.field(int, self.n_dyn)
+        self.query = ti.field(int, len(query)) # surface vertices
+        if len(static_verts) > 0:
+            self.static_pos.from_numpy(static_verts)
+        self.tri.from_numpy(all_tris)
+        self.tri_body.from_numpy(tri_body)
+        self.body.from_numpy(body.astype(np.int32))
+        self.query.from_numpy(query)
+
+        # nodes 0..n-2 are internal with node 0 the root, node n-1+k is the leaf of sorted triangle k
+        self.code = ti.field(ti.u32, self.n)
+        self.leaf_tri = ti.field(int, self.n)
+        self.child = ti.Vector.field(2, int, self.n - 1)
+        self.parent = ti.field(int, 2 * self.n - 1)
+        self.visits = ti.field(int, self.n - 1)
+        self.lo = ti.Vector.field(3, float, 2 * self.n - 1)
+        self.hi = ti.Vector.field(3, float, 2 * self.n - 1)
+        self.bound_lo = ti.Vector.field(3, float, shape=())
+        self.bound_hi = ti.Vector.field(3, float, shape=())
+
+        self.hit = ti.field(int, len(query))
+        self.dpos = ti.Vector.field(3, float, len(query))
+        self.dvel = ti.Vector.field(3, float, len(query))
+
+    @ti.func
+    def vertex(self, k):
+        res = ti.Vector([0.0, 0.0, 0.0])
+        if k < self.n_dyn:
+            res = self.pos[k]
+        else:
+            res = self.static_pos[k - self.n_dyn]
+        return res
+
+    @ti.func
+    def velocity(self, k):
+        res = ti.Vector([0.0, 0.0, 0.0])
+        if k < self.n_dyn:
+            res = self.vel[k]
+        return res
+
+    @ti.func
+    def centroid(self, t):
+        return (self.vertex(self.tri[t][0]) + self.vertex(self.tri[t][1]) + self.vertex(self.tri[t][2])) / 3
+
+    @ti.kernel
+    def compute_codes(self):
+        self.bound_lo[None] = ti.Vector([1e30, 1e30, 1e30])
+        self.bound_hi[None] = ti.Vector([-1e30, -1e30, -1e30])
+        for t in self.tri:
+            c = self.centroid(t)
+            for d in ti.static(range(3)):
+                ti.atomic_min(self.bound_lo[None][d], c[d])
+                ti.atomic_max(self.bound_hi[None][d], c[d])
+        for t in self.tri:
+            rel = (self.centroid(t) - self.bound_lo[None]) / ti.max(self.bound_hi[None] - self.bound_lo[None], 1e-12)
+            cell = ti.cast(ti.min(ti.max(rel * 1024, 0), 1023), ti.u32)
+            self.code[t] = (expand_bits(cell[0]) << 2) | (expand_bits(cell[1]) << 1) | expand_bits(cell[2])
+            self.leaf_tri[t] = t
+
+    @ti.func
+    def delta(self, i, j) -> int:
+        # length of the common prefix of the keys of sorted leaves i and j, ties broken by index
+        res = -1
+        if 0 <= j and j < self.n:
+            if self.code[i] == self.code[j]:
+                res = 32 + ti.math.clz(i ^ j)
+            else:
+                res = ti.cast(ti.math.clz(self.code[i] ^ self.code[j]), int)
+        return res
+
+    @ti.kernel
+    def link(self):
+        self.parent[0] = -1
+        for i in range(self.n - 1):
+            # direction and extent of the key range covered by internal node i
+            d = 1
+            if self.delta(i, i + 1) < self.delta(i, i - 1):
+                d = -1
+            d_min = self.delta(i, i - d)
+            l_max = 2
+            while self.delta(i, i + l_max * d) > d_min:
+                l_max *= 2
+            l = 0
+            t = l_max // 2
+            while t >= 1:
+                if self.delta(i, i + (l + t) * d) > d_min:
+                    l += t
+                t //= 2
+            j = i + l * d
+            # split position inside the range
+            d_node = self.delta(i, j)
+            s = 0
+            div = 2
+            while True:
+                t = (l + div - 1) // div
+                if self.delta(i, i + (s + t) * d) > d_node:
+                    s += t
+                div *= 2
+                if t <= 1:
+                    break
+            gamma = i + s * d + ti.min(d, 0)
+            left = gamma
+            right = gamma + 1
+            if ti.min(i, j) == gamma:
+                left += self.n - 1
+            if ti.max(i, j) == gamma + 1:
+                right += self.n - 1
+            self.child[i] = ti.Vector([left, right])
+            self.parent[left] = i
+            self.parent[right] = i
+
+    @ti.kernel
+    def refit(self):
+        for i in self.visits:
+            self.visits[i] = 0
+        for k in range(self.n):
+            t = self.leaf_tri[k]
+            a = self.vertex(self.tri[t][0])
+            b = self.vertex(self.tri[t][1])
+            c = self.vertex(self.tri[t][2])
+            node = self.n - 1 + k
+            self.lo[node] = ti.min(a, b, c) - self.thickness # leaves are padded, queries test points
+            self.hi[node] = ti.max(a, b, c) + self.thickness
+            node = self.parent[node]
+            while node >= 0:
+                if ti.atomic_add(self.visits[node], 1) == 0:
+                    break # the other child is not ready, its thread continues up
+                left = self.child[node][0]
+                right = self.child[node][1]
+                self.lo[node] = ti.min(self.lo[left], self.lo[right])
+                self.hi[node] = ti.max(self.hi[left], self.hi[right])
+                node = self.parent[node]
+
+    def build(self):
+        self.compute_codes()
+        ti.algorithms.parallel_sort(self.code, self.leaf_tri)
+        self.link()
+        self.refit()
+
+    @ti.kernel
+    def collide(self):
+        for qi in self.query:
+            v = self.query[qi]
+            p = self.pos[v]
+            best = self.thickness
+            best_q = p
+            best_t = -1
+            stack = ti.Vector.zero(int, self.stack_size)
+            top = 1
+            while top > 0:
+                top -= 1
+                node = stack[top]
+                if (p >= self.lo[node]).all() and (p <= self.hi[node]).all():
+                    if node >= self.n - 1:
+                        t = self.leaf_tri[node - (self.n - 1)]
+                        if self.tri_body[t] != self.body[v]:
+                            q = closest_point(p, self.vertex(self.tri[t][0]), self.vertex(self.tri[t][1]), self.vertex(self.tri[t][2]))
+                            dist = (p - q).norm()
+                            if dist < best:
+                                best = dist
+                                best_q = q
+                                best_t = t
+                    else:
+                        stack[top] = self.child[node][0]
+                        stack[top + 1] = self.child[node][1]
+                        top += 2
+
+            self.hit[qi] = 0
+            if best_t >= 0:
+                a = self.vertex(self.tri[best_t][0])
+                b = self.vertex(self.tri[best_t][1])
+                c = self.vertex(self.tri[best_t][2])
+                n = (b - a).cross(c - a).normalized()
+                side = (p - best_q).dot(n)
+                if side < self.thickness: # closer than the thickness or behind the face
+                    self.hit[qi] = 1
+                    self.dpos[qi] = (self.thickness - side) * n
+                    v_tri = (self.velocity(self.tri[best_t][0]) + self.velocity(self.tri[best_t][1]) + self.velocity(self.tri[best_t][2])) / 3
+                    rel = self.vel[v] - v_tri
+                    vn = rel.dot(n)
+                    dv = ti.Vector([0.0, 0.0, 0.0])
+                    if vn < 0:
+                        vt = rel - vn * n
+                        dv = -vn * n - ti.min(self.friction * -vn / (vt.norm() + 1e-12), 1.0) * vt
+                    self.dvel[qi] = dv
+
+    @ti.kernel
+    def apply(self): # corrections are applied after all queries read consistent positions
+        for qi in self.query:
+            if self.hit[qi]:
+                self.pos[self.query[qi]] += self.dpos[qi]
+                self.vel[self.query[qi]] += self.dvel[qi]
+
+    def step(self):
+        if self.steps % self.rebuild_interval == 0:
+            self.build()
+        else:
+            self.refit()
+        self.collide()
+        self.apply()
+        self.steps += 1
@@ -0,0 +1,169 @@
+import hashlib
+import os
+import queue
+import threading
+import numpy as np
+import meshio
+
+# Mesh input and time series output for the FEM scenes.
+#
+# Parsed meshes are cached as .npy files in .mesh_cache/ next to the source, keyed by
+# the hash of its contents, and memory-mapped on later runs instead of parsed again.
+# Cached arrays stay in file order, the Hilbert renumbering is cheap to redo on load.
+#
+# The connectivity never changes, so it is written once; every frame only appends
+# its positions to one raw binary file. An XDMF index (readable by ParaView) points
+# each time step at its offset in that file.
+
+cache_version = 1
+
+
+def mesh_cache_dir(path:str) -> str:
+    h = hashlib.sha1(str(cache_version).encode())
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(path)), '.mesh_cache', '%s_%s' % (stem, h.hexdigest()[:16]))
+
+
+def load_mesh(path:str):
+    # returns ({'points', 'tetra', plus whatever store_mesh() added}, cache directory)
+    directory = mesh_cache_dir(path)
+    if not os.path.exists(os.path.join(directory, 'tetra.npy')):
+        mesh = meshio.read(path)
+        store_mesh(directory, points=mesh.points.astype(np.float32), tetra=mesh.cells_dict['tetra'].astype(np.int32))
+    arrays = {}
+    for name in os.listdir(directory):
+        if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+            arrays[name[:-4]] = np.load(os.path.join(directory, name), mmap_mode='r')
+    return arrays, directory
+
+
+def store_mesh(directory:str, **arrays):
+    # add arrays derived from the mesh (e.g. the rest state) to its cache entry
+    os.makedirs(directory, exist_ok=True)
+    for name, value in arrays.items():
+        path = os.path.join(directory, name + '.npy')
+        np.save(path + '.tmp.npy', np.ascontiguousarray(value))
+        os.replace(path + '.tmp.npy', path)
+
+
+def hilbert_keys(points, bits:int=10):
+    # index of every point along a 3D Hilbert curve through a 2^bits grid over the bounding box
+    # (Skilling's transpose algorithm, vectorized over the points)
+    lo = points.min(axis=0)
+    extent = max(float((points.max(axis=0) - lo).max()), 1e-30)
+    X = np.minimum(((points - lo) / extent * (1 << bits)).astype(np.int64), (1 << bits) - 1).T.copy()
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        P = Q - 1
+        for i in range(3):
+            high = (X[i] & Q) != 0
+            X[0][high] ^= P
+            t = (X[0] ^ X[i]) & P & np.where(high, 0, -1)
+            X[0] ^= t
+            X[i] ^= t
+        Q >>= 1
+    for i in range(1, 3):
+        X[i] ^= X[i - 1]
+    t = np.zeros_like(X[0])
+    Q = 1 << (bits - 1)
+    while Q > 1:
+        t ^= np.where(X[2] & Q, Q - 1, 0)
+        Q >>= 1
+    X ^= t
+    key = np.zeros_like(X[0])
+    for b in range(bits - 1, -1, -1):
+        for i in range(3):
+            key = (key << 1) | ((X[i] >> b) & 1)
+    return key
+
+
+def hilbert_order(points, tetra):
+    # vertices along the Hilbert curve, tets by their lowest renumbered vertex;
+    # both returned as new -> old index maps
+    vert_order = np.argsort(hilbert_keys(np.asarray(points)), kind='stable')
+    rank = np.empty_like(vert_order)
+    rank[vert_order] = np.arange(len(vert_order))
+    tet_order = np.argsort(rank[tetra].min(axis=1), kind='stable')
+    return vert_order, tet_order
+
+
+def renumber(tetra, vert_order, tet_order):
+    rank = np.empty_like(vert_order)
+    rank[vert_order] = np.arange(len(vert_order))
+    return rank[tetra[tet_order]].astype(np.int32)
+
+
+class SeriesWriter:
+    def __init__(self, directory:str, name:str, cells, frame_dt:float, background:bool=True, index_every:int=50):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.num_cell = len(cells)
+        self.num_point = None
+        self.frame_dt = frame_dt
+        self.index_every = index_every
+        self.frames = 0
+        np.ascontiguousarray(cells, dtype='<i4').tofile(os.path.join(directory, name + '_topology.bin'))
+        self.positions = open(os.path.join(directory, name + '_positions.bin'), 'wb')
+
+        # positions are handed over as numpy copies, a small queue bounds the memory in flight
+        self.queue = queue.Queue(maxsize=4) if background else None
+        if background:
+            self.thread = threading.Thread(target=self._drain, daemon=True)
+            self.thread.start()
+
+    def _drain(self):
+        while True:
+            pos = self.queue.get()
+            if pos is None:
+                break
+            self.positions.write(pos.tobytes())
+
+    def write(self, pos):
+        pos = np.ascontiguousarray(pos, dtype='<f4')
+        if self.num_point is None:
+            self.num_point = len(pos)
+        assert pos.shape == (self.num_point, 3)
+        if self.queue is not None:
+            self.queue.put(pos)
+        else:
+            self.positions.write(pos.tobytes())
+        self.frames += 1
+        if self.index_every > 0 and self.frames % self.index_every == 0:
+            self.write_index()
+
+    def write_index(self):
+        # steps still in the queue may be listed before they reach the disk, readers see them after close()
+        topology = self.name + '_topology.bin'
+        positions = self.name + '_positions.bin'
+        frame_bytes = self.num_point * 3 * 4
+        lines = ['<?xml version="1.0" ?>',
+                 '<Xdmf Version="3.0">',
+                 '<Domain>',
+                 '<Grid Name="%s" GridType="Collection" CollectionType="Temporal">' % self.name]
+        for i in range(self.frames):
+            lines += ['<Grid Name="frame%d" GridType="Uniform">' % i,
+                      '<Time Value="%g"/>' % (i * self.frame_dt),
+                      '<Topology TopologyType="Tetrahedron" NumberOfElements="%d">' % self.num_cell,
+                      '<DataItem Dimensions="%d 4" NumberType="Int" Precision="4" Format="Binary" Endian="Little">%s</DataItem>' % (self.num_cell, topology),
+                      '</Topology>',
+                      '<Geometry GeometryType="XYZ">',
+                      '<DataItem Dimensions="%d 3" NumberType="Float" Precision="4" Format="Binary" Endian="Little" Seek="%d">%s</DataItem>' % (self.num_point, i * frame_bytes, positions),
+                      '</Geometry>',
+                      '</Grid>']
+        lines += ['</Grid>', '</Domain>', '</Xdmf>', '']
+        path = os.path.join(self.directory, self.name + '.xdmf')
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines))
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.positions.close()
+        if self.frames > 0:
+            self.write_index()
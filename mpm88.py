@@ -6,7 +6,12 @@ ti.init(arch=ti.gpu)
 n_particles = 8192
 n_grid = 128
 dx = 1 / n_grid
-dt = 2e-4
+dt_fixed = 2e-4
+steps_per_frame = 50
+frame_dt = dt_fixed * steps_per_frame # simulated time per rendered frame
+launch_substeps = 10 # substeps unrolled into one advance() launch, compile time grows with it
+assert steps_per_frame % launch_substeps == 0
+res = 512 # rendered image resolution
 
 p_rho = ti.field(float, n_particles)
 p_vol = (dx * 0.5) ** 2
@@ -15,6 +20,18 @@ gravity = ti.Vector.field(2, float, shape=1)
 bound = 3
 E = 400
 
+# adaptive stepping: every substep picks dt from the previous one's max grid speed and volume rate
+adaptive_dt = True
+cfl = 0.6 # fraction of a cell the fastest signal may cross per substep
+max_dJ = 0.02 # max relative volume change of a particle per substep
+dt_max = 1e-3
+wave_speed = (E / 0.8) ** 0.5 # elastic wave speed in the lighter material
+dt = ti.field(float, shape=())
+t_left = ti.field(float, shape=()) # simulated time left in the current frame
+v_max = ti.field(float, shape=())
+rate_max = ti.field(float, shape=())
+frame_substeps = ti.field(int, shape=())
+
 x = ti.Vector.field(2, float, n_particles)
 v = ti.Vector.field(2, float, n_particles)
 C = ti.Matrix.field(2, 2, float, n_particles)
@@ -23,38 +40,148 @@ J = ti.field(float, n_particles)
 grid_v = ti.Vector.field(2, float, (n_grid, n_grid))
 grid_m = ti.field(float, (n_grid, n_grid))
 
+# particles are periodically reordered by grid block so neighbors in memory share grid nodes
+sort_interval = 10 # frames between sorts, 0 disables sorting
+sort_block = 4 # grid nodes per block side, blocks are also the unit of active grid tracking
+tiled_p2g = False # accumulate each block into a scratch tile before one flush to the grid, pays off on CPU
+assert not tiled_p2g or sort_interval > 0
+n_block_x = n_grid // sort_block
+n_blocks = n_block_x * n_block_x
+tile = sort_block + 2 # a block's particles touch nodes [origin, origin + sort_block + 2)
 
-@ti.kernel
-def substep():
-    for i, j in grid_m:
-        grid_v[i, j] = [0, 0]
-        grid_m[i, j] = 0
-    for p in x:
-        Xp = x[p] / dx
-        base = int(Xp - 0.5)
-        fx = Xp - base
-        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
-        stress = -dt * 4 * E * p_vol * (J[p] - 1) / dx**2
-        affine = ti.Matrix([[stress, 0], [0, stress]]) + p_mass[p] * C[p]
-        for i, j in ti.static(ti.ndrange(3, 3)):
-            offset = ti.Vector([i, j])
-            dpos = (offset - fx) * dx
-            weight = w[i].x * w[j].y
-            grid_v[base + offset] += weight * (p_mass[p] * v[p] + affine @ dpos)
-            grid_m[base + offset] += weight * p_mass[p]
-    for i, j in grid_m:
-        if grid_m[i, j] > 0:
-            grid_v[i, j] /= grid_m[i, j]
-        grid_v[i, j] += dt * gravity[0]
-        if i < bound and grid_v[i, j].x < 0:
-            grid_v[i, j].x = 0
-        if i > n_grid - bound and grid_v[i, j].x > 0:
-            grid_v[i, j].x = 0
-        if j < bound and grid_v[i, j].y < 0:
-            grid_v[i, j].y = 0
-        if j > n_grid - bound and grid_v[i, j].y > 0:
-            grid_v[i, j].y = 0
-    for p in x:
+block_count = ti.field(int, n_blocks)
+block_start = ti.field(int, n_blocks)
+p_block = ti.field(int, n_particles)
+new_index = ti.field(int, n_particles)
+x_tmp = ti.Vector.field(2, float, n_particles)
+v_tmp = ti.Vector.field(2, float, n_particles)
+C_tmp = ti.Matrix.field(2, 2, float, n_particles)
+J_tmp = ti.field(float, n_particles)
+p_rho_tmp = ti.field(float, n_particles)
+tile_v = ti.Vector.field(2, float, (n_blocks, tile, tile))
+tile_m = ti.field(float, (n_blocks, tile, tile))
+
+# P2G compacts the blocks it touches into active_list, the grid passes only visit those
+active_grid = True
+block_active = ti.field(int, n_blocks)
+active_list = ti.field(int, n_blocks)
+n_active = ti.field(int, shape=())
+
+
+@ti.func
+def block_origin(b):
+    return ti.Vector([b // n_block_x, b % n_block_x]) * sort_block
+
+
+@ti.func
+def touch(node): # append the block of node to active_list once per substep
+    b = node[0] // sort_block * n_block_x + node[1] // sort_block
+    if block_active[b] == 0: # cheap test first, most particles find their block already listed
+        if ti.atomic_or(block_active[b], 1) == 0:
+            active_list[ti.atomic_add(n_active[None], 1)] = b
+
+
+@ti.func
+def active_node(k): # k-th node of the active blocks
+    r = k % (sort_block * sort_block)
+    return block_origin(active_list[k // (sort_block * sort_block)]) + ti.Vector([r // sort_block, r % sort_block])
+
+
+@ti.func
+def p2g(p, b): # b < 0 scatters straight into the grid
+    Xp = x[p] / dx
+    base = int(Xp - 0.5)
+    fx = Xp - base
+    w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+    stress = -dt[None] * 4 * E * p_vol * (J[p] - 1) / dx**2
+    affine = ti.Matrix([[stress, 0], [0, stress]]) + p_mass[p] * C[p]
+    local = base - block_origin(b)
+    tiled = b >= 0 and local.min() >= 0 and local.max() < sort_block # moved out of its block since the last sort
+    if ti.static(active_grid): # the 3x3 stencil spans at most 2x2 blocks
+        for i, j in ti.static(ti.ndrange(2, 2)):
+            touch(base + ti.Vector([i, j]) * 2)
+    for i, j in ti.static(ti.ndrange(3, 3)):
+        offset = ti.Vector([i, j])
+        dpos = (offset - fx) * dx
+        weight = w[i].x * w[j].y
+        dv = weight * (p_mass[p] * v[p] + affine @ dpos)
+        dm = weight * p_mass[p]
+        if tiled: # the tile is private to this thread, no atomics
+            I = local + offset
+            tile_v[b, I[0], I[1]] = tile_v[b, I[0], I[1]] + dv
+            tile_m[b, I[0], I[1]] = tile_m[b, I[0], I[1]] + dm
+        else:
+            grid_v[base + offset] += dv
+            grid_m[base + offset] += dm
+
+
+@ti.func
+def choose_dt():
+    if ti.static(adaptive_dt):
+        h = ti.min(cfl * dx / (wave_speed + v_max[None]), dt_max)
+        if rate_max[None] > 0:
+            h = ti.min(h, max_dJ / rate_max[None])
+        dt[None] = ti.min(h, t_left[None])
+        t_left[None] -= dt[None]
+        if dt[None] > 0: # keep the maxima for the next frame when this substep is skipped
+            v_max[None] = 0
+            rate_max[None] = 0
+    if dt[None] > 0:
+        frame_substeps[None] += 1
+
+
+@ti.func
+def grid_update(I):
+    if grid_m[I] > 0:
+        grid_v[I] /= grid_m[I]
+    grid_v[I] += dt[None] * gravity[0]
+    for d in ti.static(range(2)):
+        if I[d] < bound and grid_v[I][d] < 0:
+            grid_v[I][d] = 0
+        if I[d] > n_grid - bound and grid_v[I][d] > 0:
+            grid_v[I][d] = 0
+    if ti.static(adaptive_dt):
+        ti.atomic_max(v_max[None], grid_v[I].norm())
+
+
+@ti.func
+def substep_body():
+    choose_dt()
+    live = int(dt[None] > 0) # a launch may run past the end of the frame, its remaining substeps do nothing
+    if ti.static(active_grid): # only the blocks the last P2G touched hold data
+        for k in range(live * n_active[None] * sort_block * sort_block):
+            I = active_node(k)
+            grid_v[I] = [0, 0]
+            grid_m[I] = 0
+            block_active[active_list[k // (sort_block * sort_block)]] = 0
+        if live:
+            n_active[None] = 0
+    else:
+        for i, j in ti.ndrange(live * n_grid, n_grid):
+            grid_v[i, j] = [0, 0]
+            grid_m[i, j] = 0
+    if ti.static(tiled_p2g):
+        for b in range(live * n_blocks):
+            for i, j in ti.ndrange(tile, tile):
+                tile_v[b, i, j] = [0, 0]
+                tile_m[b, i, j] = 0
+            for k in range(block_count[b]):
+                p2g(block_start[b] + k, b)
+            for i, j in ti.ndrange(tile, tile):
+                node = block_origin(b) + ti.Vector([i, j])
+                if node.max() < n_grid and tile_m[b, i, j] > 0:
+                    grid_v[node] += tile_v[b, i, j]
+                    grid_m[node] += tile_m[b, i, j]
+    else:
+        for p in range(live * n_particles):
+            p2g(p, -1)
+    if ti.static(active_grid):
+        for k in range(live * n_active[None] * sort_block * sort_block):
+            grid_update(active_node(k))
+    else:
+        for I in ti.grouped(ti.ndrange(live * n_grid, n_grid)):
+            grid_update(I)
+    for p in range(live * n_particles):
         Xp = x[p] / dx
         base = int(Xp - 0.5)
         fx = Xp - base
@@ -69,13 +196,88 @@ def substep():
             new_v += weight * g_v
             new_C += 4 * weight * g_v.outer_product(dpos) / dx**2
         v[p] = new_v
-        x[p] += dt * v[p]
-        J[p] *= 1 + dt * new_C.trace()
+        x[p] += dt[None] * v[p]
+        J[p] *= 1 + dt[None] * new_C.trace()
         C[p] = new_C
+        if ti.static(adaptive_dt):
+            ti.atomic_max(rate_max[None], ti.abs(new_C.trace()))
+
+
+@ti.kernel
+def substep():
+    substep_body()
+
+
+@ti.kernel
+def advance(): # launch_substeps substeps in one launch
+    for _ in ti.static(range(launch_substeps)):
+        substep_body()
+
+
+def advance_frame():
+    frame_substeps[None] = 0
+    if not adaptive_dt:
+        for _ in range(steps_per_frame // launch_substeps):
+            advance()
+        return
+    t_left[None] = frame_dt
+    while t_left[None] > 0: # one sync per launch
+        if t_left[None] > launch_substeps * dt[None]:
+            advance()
+        else:
+            substep() # finish the frame one substep at a time
+
+
+img = ti.Vector.field(3, float, (res, res))
+
+
+@ti.kernel
+def render(): # rasterize particles straight into img
+    for i, j in img:
+        img[i, j] = [0x11 / 255, 0x2F / 255, 0x41 / 255]
+    for p in x:
+        color = ti.Vector([1.0, 0.0, 0.0]) # water
+        if p_rho[p] >= 0.9:
+            color = ti.Vector([0.0, 1.0, 0.0]) # oil
+        center = x[p] * res
+        for di, dj in ti.static(ti.ndrange((-2, 3), (-2, 3))):
+            I = int(center) + ti.Vector([di, dj])
+            if 0 <= I.min() and I.max() < res and (I + 0.5 - center).norm() <= 1.5:
+                img[I] = color
+
+
+@ti.kernel
+def sort_particles(): # counting sort by grid block
+    for b in block_count:
+        block_count[b] = 0
+    for p in x:
+        base = ti.max(ti.min(int(x[p] / dx - 0.5) // sort_block, n_block_x - 1), 0)
+        p_block[p] = base[0] * n_block_x + base[1]
+        new_index[p] = ti.atomic_add(block_count[p_block[p]], 1)
+    start = 0
+    ti.loop_config(serialize=True)
+    for b in range(n_blocks):
+        block_start[b] = start
+        start += block_count[b]
+    for p in x:
+        q = block_start[p_block[p]] + new_index[p]
+        x_tmp[q] = x[p]
+        v_tmp[q] = v[p]
+        C_tmp[q] = C[p]
+        J_tmp[q] = J[p]
+        p_rho_tmp[q] = p_rho[p]
+    for p in x:
+        x[p] = x_tmp[p]
+        v[p] = v_tmp[p]
+        C[p] = C_tmp[p]
+        J[p] = J_tmp[p]
+        p_rho[p] = p_rho_tmp[p]
+        p_mass[p] = p_vol * p_rho[p]
 
 
 @ti.kernel
 def init():
+    dt[None] = dt_fixed
     for i in range(n_particles):
         x[i] = [ti.random() * 0.4 + 0.2, ti.random() * 0.4 + 0.2]
         v[i] = [0, -1]
@@ -89,7 +291,8 @@ def init():
 
 
 init()
-gui = ti.GUI("MPM88")
+gui = ti.GUI("MPM88", res=res)
+frame = 0
 while gui.running:
     gui.get_event()
     if gui.is_pressed('w'):
@@ -101,12 +304,11 @@ while gui.running:
     elif gui.is_pressed('d'):
         gravity[0] = ti.Vector([9.8, 0])
 
-    for s in range(50):
-        substep()
-    gui.clear(0x112F41)
-    show_x = x.to_numpy()
-    show_water = show_x[:4096]
-    show_oil = show_x[4096:]
-    gui.circles(show_water, radius=1.5, color=0xFF0000)
-    gui.circles(show_oil, radius=1.5, color=0x00FF00)
+    if sort_interval > 0 and frame % sort_interval == 0:
+        sort_particles()
+    advance_frame()
+    frame += 1
+    render()
+    gui.set_image(img)
+    gui.text(content=f'substeps: {frame_substeps[None]}, active blocks: {n_active[None]} / {n_blocks}', pos=[0.02, 0.98], color=0xFFFFFF)
     gui.show()
\ No newline at end of file
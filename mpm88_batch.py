@@ -0,0 +1,126 @@
+# Batched MPM88: K independent scenes with their own E, densities and gravity advanced by one launch
+import math
+import taichi as ti
+
+ti.init(arch=ti.gpu)
+
+n_scenes = 8
+n_particles = 8192
+n_grid = 128
+dx = 1 / n_grid
+dt = 2e-4
+
+p_vol = (dx * 0.5) ** 2
+bound = 3
+
+# per-scene parameters
+E = ti.field(float, n_scenes)
+rho = ti.Vector.field(2, float, n_scenes) # density of the first and the second half of the particles
+gravity = ti.Vector.field(2, float, n_scenes)
+
+p_mass = ti.field(float, (n_scenes, n_particles))
+x = ti.Vector.field(2, float, (n_scenes, n_particles))
+v = ti.Vector.field(2, float, (n_scenes, n_particles))
+C = ti.Matrix.field(2, 2, float, (n_scenes, n_particles))
+J = ti.field(float, (n_scenes, n_particles))
+
+grid_v = ti.Vector.field(2, float, (n_scenes, n_grid, n_grid))
+grid_m = ti.field(float, (n_scenes, n_grid, n_grid))
+
+
+@ti.kernel
+def substep():
+    for s, i, j in grid_m:
+        grid_v[s, i, j] = [0, 0]
+        grid_m[s, i, j] = 0
+    for s, p in x:
+        Xp = x[s, p] / dx
+        base = int(Xp - 0.5)
+        fx = Xp - base
+        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+        stress = -dt * 4 * E[s] * p_vol * (J[s, p] - 1) / dx**2
+        affine = ti.Matrix([[stress, 0], [0, stress]]) + p_mass[s, p] * C[s, p]
+        for i, j in ti.static(ti.ndrange(3, 3)):
+            offset = ti.Vector([i, j])
+            dpos = (offset - fx) * dx
+            weight = w[i].x * w[j].y
+            I = base + offset
+            grid_v[s, I[0], I[1]] += weight * (p_mass[s, p] * v[s, p] + affine @ dpos)
+            grid_m[s, I[0], I[1]] += weight * p_mass[s, p]
+    for s, i, j in grid_m:
+        if grid_m[s, i, j] > 0:
+            grid_v[s, i, j] /= grid_m[s, i, j]
+        grid_v[s, i, j] += dt * gravity[s]
+        if i < bound and grid_v[s, i, j].x < 0:
+            grid_v[s, i, j].x = 0
+        if i > n_grid - bound and grid_v[s, i, j].x > 0:
+            grid_v[s, i, j].x = 0
+        if j < bound and grid_v[s, i, j].y < 0:
+            grid_v[s, i, j].y = 0
+        if j > n_grid - bound and grid_v[s, i, j].y > 0:
+            grid_v[s, i, j].y = 0
+    for s, p in x:
+        Xp = x[s, p] / dx
+        base = int(Xp - 0.5)
+        fx = Xp - base
+        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+        new_v = ti.Vector.zero(float, 2)
+        new_C = ti.Matrix.zero(float, 2, 2)
+        for i, j in ti.static(ti.ndrange(3, 3)):
+            offset = ti.Vector([i, j])
+            dpos = (offset - fx) * dx
+            weight = w[i].x * w[j].y
+            I = base + offset
+            g_v = grid_v[s, I[0], I[1]]
+            new_v += weight * g_v
+            new_C += 4 * weight * g_v.outer_product(dpos) / dx**2
+        v[s, p] = new_v
+        x[s, p] += dt * v[s, p]
+        J[s, p] *= 1 + dt * new_C.trace()
+        C[s, p] = new_C
+
+
+@ti.kernel
+def init():
+    for s, i in x:
+        x[s, i] = [ti.random() * 0.4 + 0.2, ti.random() * 0.4 + 0.2]
+        v[s, i] = [0, -1]
+        C[s, i] = ti.Matrix.zero(float, 2, 2)
+        J[s, i] = 1
+        if i*2 < n_particles:
+            p_mass[s, i] = p_vol * rho[s][0]
+        else:
+            p_mass[s, i] = p_vol * rho[s][1]
+
+
+def set_scene(s:int, young:float, density, g):
+    E[s] = young
+    rho[s] = density
+    gravity[s] = g
+
+
+def render(gui, show_x):
+    # scenes are tiled row by row, scene 0 in the top left corner
+    cols = math.ceil(math.sqrt(n_scenes))
+    rows = math.ceil(n_scenes / cols)
+    scale = 1.0 / max(cols, rows)
+    for s in range(n_scenes):
+        origin = [(s % cols) * scale, 1.0 - (s // cols + 1) * scale]
+        pos = show_x[s] * scale + origin
+        gui.circles(pos[:n_particles // 2], radius=1.0, color=0xFF0000)
+        gui.circles(pos[n_particles // 2:], radius=1.0, color=0x00FF00)
+
+
+if __name__ == '__main__':
+    # sweep: E doubles along the row (100..800, mpm88 uses 400), the light phase gets lighter and gravity tilts every other scene
+    for s in range(n_scenes):
+        set_scene(s, 100 * 2 ** (s % 4), (0.8 - 0.2 * (s // 4), 1.0), (0, -9.8) if s % 2 == 0 else (-4.9, -8.5))
+    init()
+    gui = ti.GUI("MPM88 batch", res=800)
+    while gui.running:
+        gui.get_event()
+        for _ in range(50):
+            substep()
+        gui.clear(0x112F41)
+        render(gui, x.to_numpy())
+        gui.show()
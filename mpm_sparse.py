@@ -0,0 +1,167 @@
+# Dimension-generic MLS-MPM on a sparse grid, grown out of mpm88.py
+# Only grid blocks touched by particles are allocated, cleared and updated.
+import taichi as ti
+
+ti.init(arch=ti.cuda) # sparse SNodes need the CUDA or CPU backend
+
+dim = 3
+n_grid = 256
+leaf_block = 8 # grid nodes per block side
+dx = 1 / n_grid
+block_size = 0.2 # side of the initial particle block
+n_particles = int(block_size * n_grid) ** dim * 2 ** dim # 2^dim particles per cell, as p_vol assumes
+
+p_rho = ti.field(float, n_particles)
+p_vol = (dx * 0.5) ** dim
+p_mass = ti.field(float, n_particles)
+gravity = ti.Vector.field(dim, float, shape=1)
+bound = 3
+E = 400
+cfl = 0.3 # fraction of a cell the elastic wave may cross per substep
+wave_speed = (E / 0.8) ** 0.5 # elastic wave speed in the lighter material
+dt = cfl * dx / wave_speed # 5.2e-5 at n_grid = 256, mpm88's fixed 2e-4 diverges there
+escaped = ti.field(int, shape=()) # particles whose stencil left the grid, set once the run diverges
+
+x = ti.Vector.field(dim, float, n_particles)
+v = ti.Vector.field(dim, float, n_particles)
+C = ti.Matrix.field(dim, dim, float, n_particles)
+J = ti.field(float, n_particles)
+
+grid_v = ti.Vector.field(dim, float)
+grid_m = ti.field(float)
+indices = ti.ijk if dim == 3 else ti.ij
+grid_block = ti.root.pointer(indices, n_grid // leaf_block)
+grid_block.bitmasked(indices, leaf_block).place(grid_v, grid_m)
+
+
+@ti.func
+def in_grid(base): # the 3^dim stencil at base lies inside the grid, false for NaN positions too
+    return 0 <= base.min() and base.max() + 2 < n_grid
+
+
+@ti.kernel
+def p2g():
+    for p in x:
+        Xp = x[p] / dx
+        base = int(Xp - 0.5)
+        if not in_grid(base):
+            escaped[None] += 1
+            continue
+        fx = Xp - base
+        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+        stress = -dt * 4 * E * p_vol * (J[p] - 1) / dx**2
+        affine = ti.Matrix.identity(float, dim) * stress + p_mass[p] * C[p]
+        for offset in ti.static(ti.grouped(ti.ndrange(*((3, ) * dim)))):
+            dpos = (offset - fx) * dx
+            weight = 1.0
+            for d in ti.static(range(dim)):
+                weight *= w[offset[d]][d]
+            grid_v[base + offset] += weight * (p_mass[p] * v[p] + affine @ dpos)
+            grid_m[base + offset] += weight * p_mass[p]
+
+
+@ti.kernel
+def grid_op():
+    for I in ti.grouped(grid_m):
+        if grid_m[I] > 0:
+            grid_v[I] /= grid_m[I]
+        grid_v[I] += dt * gravity[0]
+        for d in ti.static(range(dim)):
+            if I[d] < bound and grid_v[I][d] < 0:
+                grid_v[I][d] = 0
+            if I[d] > n_grid - bound and grid_v[I][d] > 0:
+                grid_v[I][d] = 0
+
+
+@ti.kernel
+def g2p():
+    for p in x:
+        Xp = x[p] / dx
+        base = int(Xp - 0.5)
+        if not in_grid(base):
+            continue
+        fx = Xp - base
+        w = [0.5 * (1.5 - fx) ** 2, 0.75 - (fx - 1) ** 2, 0.5 * (fx - 0.5) ** 2]
+        new_v = ti.Vector.zero(float, dim)
+        new_C = ti.Matrix.zero(float, dim, dim)
+        for offset in ti.static(ti.grouped(ti.ndrange(*((3, ) * dim)))):
+            dpos = (offset - fx) * dx
+            weight = 1.0
+            for d in ti.static(range(dim)):
+                weight *= w[offset[d]][d]
+            g_v = grid_v[base + offset]
+            new_v += weight * g_v
+            new_C += 4 * weight * g_v.outer_product(dpos) / dx**2
+        v[p] = new_v
+        x[p] += dt * v[p]
+        J[p] *= 1 + dt * new_C.trace()
+        C[p] = new_C
+
+
+def substep():
+    grid_block.deactivate_all() # clears exactly the blocks the previous P2G touched
+    p2g()
+    grid_op()
+    g2p()
+
+
+@ti.kernel
+def init():
+    for i in range(n_particles):
+        for d in ti.static(range(dim)):
+            x[i][d] = ti.random() * block_size + 0.2
+            v[i][d] = -1 if d == 1 else 0
+        J[i] = 1
+        if i*2 < n_particles:
+            p_rho[i] = 0.8
+        else:
+            p_rho[i] = 1.0
+
+        p_mass[i] = p_vol * p_rho[i]
+
+
+@ti.kernel
+def active_blocks() -> int:
+    res = 0
+    for I in ti.grouped(grid_block):
+        res += 1
+    return res
+
+
+def set_gravity(axis:int, value:float):
+    g = [0.0] * dim
+    g[axis] = value
+    gravity[0] = g
+
+
+def project(pos):
+    # oblique projection of 3D particles onto the screen
+    if dim == 2:
+        return pos
+    return pos[:, :2] + 0.3 * (pos[:, 2:3] - 0.5) * [0.6, 0.4]
+
+
+if __name__ == '__main__':
+    init()
+    gui = ti.GUI("MPM sparse")
+    while gui.running:
+        gui.get_event()
+        if gui.is_pressed('w'):
+            set_gravity(1, 9.8)
+        elif gui.is_pressed('s'):
+            set_gravity(1, -9.8)
+        elif gui.is_pressed('a'):
+            set_gravity(0, -9.8)
+        elif gui.is_pressed('d'):
+            set_gravity(0, 9.8)
+
+        for s in range(50):
+            substep()
+        if escaped[None] > 0:
+            raise RuntimeError(f'{escaped[None]} particles left the grid, the run diverged (dt = {dt:.2e})')
+        gui.clear(0x112F41)
+        show_x = project(x.to_numpy())
+        gui.circles(show_x[:n_particles // 2], radius=1.0, color=0xFF0000)
+        gui.circles(show_x[n_particles // 2:], radius=1.0, color=0x00FF00)
+        gui.text(content=f'active blocks: {active_blocks()}', pos=[0.02, 0.98], color=0xFFFFFF)
+        gui.show()
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import math
+import os
+import numpy as np
+
+# Particle layouts for the SPH scenes, built with numpy and uploaded with a single from_numpy.
+# Layouts are cached in .scene_cache/ keyed by the builder name and its parameters.
+
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.scene_cache')
+cache_version = 1
+
+
+def cached(builder, **params) -> dict:
+    key = json.dumps([builder.__name__, cache_version, params], sort_keys=True)
+    path = os.path.join(cache_dir, '%s_%s.npz' % (builder.__name__, hashlib.sha1(key.encode()).hexdigest()[:16]))
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return dict(data)
+
+    res = builder(**params)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **res)
+    os.replace(tmp, path)
+    return res
+
+
+def ring_count(r:float, dis:float) -> int:
+    # number of particles spaced dis apart on a ring of radius r
+    d_theta = 2.0 * math.asin(0.5 * dis / r)
+    return int((2 * math.pi) / d_theta)
+
+
+def ring_layer(center, radii, dis:float) -> np.ndarray:
+    # one layer of concentric rings in the z=0 plane, ordered by ring, then angle
+    radii = np.asarray(radii, dtype=np.float64)
+    counts = np.array([ring_count(r, dis) for r in radii], dtype=np.int64)
+    ring = np.repeat(np.arange(len(radii)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    theta = k * 2.0 * np.arcsin(0.5 * dis / radii[ring])
+    r = radii[ring]
+    return np.stack([center[0] + r * np.cos(theta), center[1] + r * np.sin(theta), np.zeros_like(r)], axis=1)
+
+
+def stack_layers(layer:np.ndarray, z) -> np.ndarray:
+    z = np.asarray(z, dtype=np.float64)
+    res = np.tile(layer, (len(z), 1))
+    res[:, 2] = np.repeat(z, len(layer))
+    return res
+
+
+def block(origin, count:int, num:int, dis:float) -> np.ndarray:
+    # count particles filling num x num layers upwards from origin
+    i = np.arange(count)
+    plane = i % (num * num)
+    offset = np.stack([plane % num, plane // num, i // (num * num)], axis=1)
+    return np.asarray(origin, dtype=np.float64) + offset * dis
+
+
+def box_shell(num_x:int, num_y:int, num_z:int, layer:int, gap:float) -> np.ndarray:
+    # open-top box of wall particles: a floor of `layer` sheets plus four side walls `layer` thick
+    def grid(rx, ry, rz):
+        i, j, k = np.meshgrid(np.arange(*rx), np.arange(*ry), np.arange(*rz), indexing='ij')
+        return np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1)
+
+    idx = np.concatenate([
+        grid((0, num_x), (0, num_y), (0, layer)), # floor
+        grid((0, num_x), (0, layer), (layer, num_z)),
+        grid((0, num_x), (num_y - layer, num_y), (layer, num_z)),
+        grid((0, layer), (layer, num_y - layer), (layer, num_z)),
+        grid((num_x - layer, num_x), (layer, num_y - layer), (layer, num_z)),
+    ])
+    return (idx + 1) * gap
+
+
+def centrifuge(center, water_radius:int, wall_radius:int, height:int, wall_layer:int, dis:float, walls:bool=True) -> dict:
+    # fluid rings of radius i*dis inside a cylinder whose side wall is wall_radius rings spaced 0.5*dis
+    # and whose caps are wall_layer full layers; heights are j*dis for j in [1, height + 2*wall_layer]
+    fluid_radii = np.arange(1, water_radius + 1) * dis
+    wall_radii = water_radius * dis + np.arange(1, wall_radius + 1) * 0.5 * dis
+    fluid_z = np.arange(wall_layer + 1, wall_layer + height + 1) * dis
+    cap_z = np.concatenate([np.arange(1, wall_layer + 1), np.arange(wall_layer + height + 1, height + 2 * wall_layer + 1)]) * dis
+
+    res = {'fluid': stack_layers(ring_layer(center, fluid_radii, dis), fluid_z).astype(np.float32)}
+    if walls:
+        side = stack_layers(ring_layer(center, wall_radii, dis), fluid_z)
+        caps = stack_layers(ring_layer(center, np.concatenate([fluid_radii, wall_radii]), dis), cap_z)
+        res['wall'] = np.concatenate([side, caps]).astype(np.float32)
+    else:
+        res['wall'] = np.zeros((0, 3), dtype=np.float32)
+    return res
+
+
+def dam_break(blocks, count:int, num:int, dis:float, wall_num, wall_layer:int, wall_gap:float, walls:bool=True) -> dict:
+    # `count` fluid particles split evenly over the block origins, then the container walls
+    per_block = count // len(blocks)
+    fluid = [block(origin, per_block, num, dis) for origin in blocks]
+    res = {'fluid': np.concatenate(fluid).astype(np.float32)}
+    if walls:
+        res['wall'] = box_shell(*wall_num, wall_layer, wall_gap).astype(np.float32)
+    else:
+        res['wall'] = np.zeros((0, 3), dtype=np.float32)
+    return res
@@ -0,0 +1,159 @@
+import taichi as ti
+import taichi.math as tm
+
+# Density-map boundaries for the 3D SPH scenes.
+# The static walls are described by a signed distance function (sdf < 0 is solid)
+# and treated as a continuum of wall particles with number density n. For every
+# node of a regular grid we precompute
+#   w_map(x)  = sum_j W(|x - x_j|)
+#   dw_map(x) = sum_j DW(x - x_j)
+# over those virtual wall particles, so a fluid particle gets its whole boundary
+# contribution from one trilinear lookup instead of looping over wall neighbors.
+
+
+@ti.data_oriented
+class BoundaryMap:
+    def __init__(self, lower, upper, dx:float, h:float, n:float, sample_dx:float=0.0):
+        self.lower = ti.Vector(lower)
+        self.dx = dx
+        self.h = h
+        self.n = n
+        self.sample_dx = sample_dx if sample_dx > 0 else dx
+        self.res = [int(ti.ceil((upper[d] - lower[d]) / dx)) + 1 for d in range(3)]
+        self.w_map = ti.field(float, shape=self.res)
+        self.dw_map = ti.Vector.field(3, float, shape=self.res)
+
+    @ti.func
+    def sdf(self, p) -> float:
+        return 1.0
+
+    @ti.func
+    def number_density(self, p) -> float:
+        return self.n
+
+    @ti.func
+    def W(self, r:float) -> float:
+        res = 0.0
+        if 0 < r and r < self.h:
+            x = (self.h * self.h - r * r) / (self.h**3)
+            res = 315.0 / 64.0 / tm.pi * x * x * x
+        return res
+
+    @ti.func
+    def DW(self, r) -> ti.Vector:
+        res = ti.Vector([0.0, 0.0, 0.0])
+        r_len = r.norm()
+        if 0 < r_len and r_len < self.h:
+            x = (self.h - r_len) / (self.h * self.h * self.h)
+            g_factor = -45.0 / tm.pi * x * x
+            res = r * g_factor / r_len
+        return res
+
+    @ti.kernel
+    def build(self):
+        q = self.sample_dx
+        m = int(ti.ceil(self.h / q))
+        for I in ti.grouped(self.w_map):
+            x = self.lower + I * self.dx
+            w = 0.0
+            dw = ti.Vector([0.0, 0.0, 0.0])
+            if self.sdf(x) < self.h: # nodes deeper than h inside the fluid see no wall
+                for a, b, c in ti.ndrange((-m, m + 1), (-m, m + 1), (-m, m + 1)):
+                    y = x + ti.Vector([a, b, c]) * q
+                    if self.sdf(y) < 0:
+                        vol = self.number_density(y) * q * q * q # wall particles in this sample cell
+                        w += vol * self.W((x - y).norm())
+                        dw += vol * self.DW(x - y)
+
+            self.w_map[I] = w
+            self.dw_map[I] = dw
+
+    @ti.func
+    def locate(self, p):
+        g = (p - self.lower) / self.dx
+        base = ti.cast(ti.floor(g), int)
+        inside = True
+        for d in ti.static(range(3)):
+            if base[d] < 0 or base[d] >= self.res[d] - 1:
+                inside = False
+        return base, g - base, inside
+
+    @ti.func
+    def density(self, p) -> float: # sum_j W(|p - x_j|) over the walls
+        base, fx, inside = self.locate(p)
+        res = 0.0
+        if inside:
+            for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
+                weight = (fx[0] if i else 1 - fx[0]) * (fx[1] if j else 1 - fx[1]) * (fx[2] if k else 1 - fx[2])
+                res += weight * self.w_map[base + ti.Vector([i, j, k])]
+        return res
+
+    @ti.func
+    def gradient(self, p) -> ti.Vector: # sum_j DW(p - x_j) over the walls
+        base, fx, inside = self.locate(p)
+        res = ti.Vector([0.0, 0.0, 0.0])
+        if inside:
+            for i, j, k in ti.static(ti.ndrange(2, 2, 2)):
+                weight = (fx[0] if i else 1 - fx[0]) * (fx[1] if j else 1 - fx[1]) * (fx[2] if k else 1 - fx[2])
+                res += weight * self.dw_map[base + ti.Vector([i, j, k])]
+        return res
+
+
+@ti.func
+def sd_box(p, lo, hi) -> float:
+    q = ti.abs(p - 0.5 * (lo + hi)) - 0.5 * (hi - lo)
+    return ti.max(q, 0.0).norm() + ti.min(ti.max(q[0], q[1], q[2]), 0.0)
+
+
+@ti.func
+def sd_cylinder(p, center, radius:float, z_lo:float, z_hi:float) -> float:
+    d = ti.Vector([(p.xy - center).norm() - radius, ti.abs(p[2] - 0.5 * (z_lo + z_hi)) - 0.5 * (z_hi - z_lo)])
+    return ti.max(d, 0.0).norm() + ti.min(ti.max(d[0], d[1]), 0.0)
+
+
+@ti.data_oriented
+class OpenBox(BoundaryMap):
+    # box container with an open top, fluid lives in [inner_lo, inner_hi]
+    def __init__(self, inner_lo, inner_hi, thickness:float, top:float, dx:float, h:float, n:float, sample_dx:float=0.0):
+        self.inner_lo = ti.Vector(inner_lo)
+        self.inner_hi = ti.Vector([inner_hi[0], inner_hi[1], top + 2 * h]) # open above the walls
+        self.outer_lo = ti.Vector(inner_lo) - thickness
+        self.outer_hi = ti.Vector([inner_hi[0] + thickness, inner_hi[1] + thickness, top])
+        lower = [self.outer_lo[d] - h for d in range(3)]
+        upper = [self.outer_hi[d] + h for d in range(3)]
+        super().__init__(lower, upper, dx, h, n, sample_dx)
+
+    @ti.func
+    def sdf(self, p) -> float:
+        return ti.max(sd_box(p, self.outer_lo, self.outer_hi), -sd_box(p, self.inner_lo, self.inner_hi))
+
+
+@ti.data_oriented
+class Cylinder(BoundaryMap):
+    # closed cylinder around the z axis, fluid lives in radius < radius and z_lo < z < z_hi;
+    # side and cap walls may be sampled with different wall particle densities
+    def __init__(self, center, radius:float, z_lo:float, z_hi:float, side:float, cap:float, dx:float, h:float, n_side:float, n_cap:float, sample_dx:float=0.0):
+        self.center = ti.Vector(center)
+        self.radius = radius
+        self.z_lo = z_lo
+        self.z_hi = z_hi
+        self.side = side
+        self.cap = cap
+        self.n_cap = n_cap
+        r = radius + side + h
+        lower = [center[0] - r, center[1] - r, z_lo - cap - h]
+        upper = [center[0] + r, center[1] + r, z_hi + cap + h]
+        super().__init__(lower, upper, dx, h, n_side, sample_dx)
+
+    @ti.func
+    def sdf(self, p) -> float:
+        outer = sd_cylinder(p, self.center, self.radius + self.side, self.z_lo - self.cap, self.z_hi + self.cap)
+        inner = sd_cylinder(p, self.center, self.radius, self.z_lo, self.z_hi)
+        return ti.max(outer, -inner)
+
+    @ti.func
+    def number_density(self, p) -> float:
+        res = self.n
+        if (p.xy - self.center).norm() < self.radius:
+            res = self.n_cap
+        return res
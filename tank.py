@@ -52,6 +52,17 @@ Particles = ti.field(int, shape = (int(numCell), total_num))
 NeiNum = ti.field(int, shape = total_num)
 neighbor = ti.field(int, shape = (total_num, total_num))
 
+# emitter
+max_emitter = 8
+max_emit_rate = 64
+emitter_n = ti.field(int, shape=())
+emitter_pos = ti.Vector.field(2, float, shape = max_emitter) # first particle is placed at pos + span
+emitter_span = ti.Vector.field(2, float, shape = max_emitter) # offset between particles of one emission
+emitter_vel = ti.Vector.field(2, float, shape = max_emitter) # direction * speed
+emitter_rate = ti.field(int, shape = max_emitter) # particles per emission
+emitter_jitter = ti.field(float, shape = max_emitter)
+emitter_alpha = ti.field(float, shape = (max_emitter, phase))
+
 # rendering
 palette = ti.Vector.field(3, float, shape = fluid_n)
 particle_pos = ti.Vector.field(3, float, shape = fluid_n)
@@ -104,15 +115,13 @@ def boundry(idx:int):
 def neighbor_search():
     NeiNum.fill(0)
     ParNum.fill(0)
-    Particles.fill(0)
-    neighbor.fill(0)
 
     for i in range(wallNum+cur_n[None]):
         idx = int(pos[i][0]/cellSize-0.5) + int(pos[i][1]/cellSize-0.5) * numCellX
         k = ti.atomic_add(ParNum[int(idx)], 1)
         Particles[int(idx), k] = i
 
-    for i in range(wallNum+cur_n[None]):
+    for i in range(wallNum, wallNum+cur_n[None]): # walls don't need neighbors
         idx_x = int(pos[i][0]/cellSize - 0.5)
         idx_y = int(pos[i][1]/cellSize - 0.5)
         kk = 0
@@ -152,14 +161,45 @@ def init():
         pos[wallNumX*3+6*i+5] = ti.Vector([(wallNumX-0)*0.4, (i+4) * 0.4])
 
 
+def add_emitter(p, v, rate:int, fractions, span=(0.0, 0.65), jitter:float=0.0):
+    assert emitter_n[None] < max_emitter and rate <= max_emit_rate and len(fractions) == phase
+    e = emitter_n[None]
+    emitter_pos[e] = p
+    emitter_span[e] = span
+    emitter_vel[e] = v
+    emitter_rate[e] = rate
+    emitter_jitter[e] = jitter
+    for ph in range(phase):
+        emitter_alpha[e, ph] = fractions[ph]
+    emitter_n[None] += 1
+
+
+@ti.kernel
+def emit():
+    for e, k in ti.ndrange(max_emitter, max_emit_rate):
+        if e < emitter_n[None] and k < emitter_rate[e]:
+            idx = ti.atomic_add(cur_n[None], 1)
+            if idx < fluid_n:
+                i = wallNum + idx
+                jitter = emitter_jitter[e] * ti.Vector([ti.random() - 0.5, ti.random() - 0.5])
+                pos[i] = emitter_pos[e] + (k + 1) * emitter_span[e] + jitter
+                vel[i] = emitter_vel[e]
+                acc[i] = ti.Vector([0.0, 0.0])
+                for ph in range(phase):
+                    alpha[i, ph] = emitter_alpha[e, ph]
+                    drift_vel[i, ph] = ti.Vector([0.0, 0.0])
+
+    cur_n[None] = ti.min(cur_n[None], fluid_n)
+
+
 @ti.kernel
 def cal_press():
-    for i in rho_m:
+    for i in range(wallNum, wallNum+cur_n[None]):
         rho_m[i] = 0.0
         for ph in range(phase):
             rho_m[i] += alpha[i, ph] * rho_0[ph]
     
-    for i in rho_bar: # we can assume V=1
+    for i in range(wallNum, wallNum+cur_n[None]): # we can assume V=1
         rho_bar[i] = 0.0
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
@@ -171,14 +211,14 @@ def cal_press():
         if rho_bar[i] < 1e-6:
             rho_bar[i] = rho_m[i]
     
-    for i in prs:
+    for i in range(wallNum, wallNum+cur_n[None]):
         density = ti.max(rho_bar[i], rho_m[i])
         prs[i] = k3 * (density - rho_m[i])
 
 
 @ti.kernel
 def cal_drift():
-    for i, k in drift_vel:
+    for i, k in ti.ndrange((wallNum, wallNum+cur_n[None]), phase):
         first_term = (g[0] - acc[i]) * tao
         coef = rho_0[k]
         for ph in range(phase):
@@ -206,7 +246,7 @@ def cal_drift():
 
 @ti.kernel
 def adv_alpha(): # formula 17, 18
-    for i, k in alpha:
+    for i, k in ti.ndrange((wallNum, wallNum+cur_n[None]), phase):
         first_term = 0.0
         for nei in range(NeiNum[i]):
             j = neighbor[i, nei]
@@ -228,7 +268,7 @@ def adv_alpha(): # formula 17, 18
 
 @ti.kernel
 def check_alpha():
-    for i in range(fluid_n):
+    for i in range(wallNum, wallNum+cur_n[None]):
         tot = 0.0
         for ph in range(phase):
             if alpha[i, ph] > 0:
@@ -254,7 +294,7 @@ def check_alpha():
 
 @ti.kernel
 def cal_acc():
-    for i in acc:
+    for i in range(wallNum, wallNum+cur_n[None]):
         acc[i] = g[0]
         prs_grad = ti.Vector([0.0, 0.0])
         Tdm_grad = ti.Vector([0.0, 0.0])
@@ -282,12 +322,11 @@ def cal_acc():
             
 @ti.kernel
 def advect():
-    for i in vel:
-        if i >= wallNum:
-            vel[i] *= damp
-            vel[i] += dt * acc[i]
-            pos[i] += dt * vel[i]
-            boundry(i)
+    for i in range(wallNum, wallNum+cur_n[None]):
+        vel[i] *= damp
+        vel[i] += dt * acc[i]
+        pos[i] += dt * vel[i]
+        boundry(i)
 
 
 @ti.kernel
@@ -299,23 +338,14 @@ def pre_render():
 
 if __name__ == '__main__':
     init()
+    add_emitter((0.05 * boundX, 0.8 * boundY), (30.0, 0.0), 5, (1.0, 0.0)) # water
+    add_emitter((0.95 * boundX, 0.8 * boundY), (-40.0, 0.0), 5, (0.0, 1.0)) # oil
     cur_frame = 0
     gui = ti.GUI('SPH', res = (800, 800))
     while gui.running:
         
-        if cur_n[None] < fluid_n - 10 :
-            cur_n[None] += 10
-            for idx in range(cur_n[None]-5, cur_n[None]):
-                pos[wallNum+idx] = ti.Vector([0.05 * boundX, 0.8 * boundY + (cur_n[None] - idx) * 0.65])
-                vel[wallNum+idx] = ti.Vector([30.0, 0.0])
-                alpha[wallNum+idx, 0] = 1.0
-                alpha[wallNum+idx, 1] = 0.0
-            
-            for idx in range(cur_n[None]-10, cur_n[None]-5):
-                pos[wallNum+idx] = ti.Vector([0.95 * boundX, 0.8 * boundY + (cur_n[None] - idx - 5) * 0.65])
-                vel[wallNum+idx] = ti.Vector([-40.0, 0.0])
-                alpha[wallNum+idx, 0] = 0.0
-                alpha[wallNum+idx, 1] = 1.0
+        if cur_n[None] < fluid_n:
+            emit()
         
         for _ in range(substep):
             neighbor_search()